@@ -2,22 +2,12 @@
 
 # Run over all of the given examples and produce some nice CSVs
 
-PARTICLE_COUNTS=`echo {500..2000..500}`
-RUN="python2 run.py"
+EXPERIMENT="python2 experiment.py"
 DEST_DIR=results/
 MANGLE="python2 mangle_data.py"
 
 mkdir -p "$DEST_DIR"
 
-child_block() {
-    # Will block until the process has less than the number of CPUs + 1 child
-    # processes
-    max="`expr $(nproc) - 2`"
-    while [ "$(ps --ppid=$$ --no-header | wc -l)" -gt "$max" ]; do
-        sleep 1
-    done
-}
-
 scrape() {
     # Scrape generated CSVs to produce something that can be thrown in the
     # final report
@@ -128,29 +118,9 @@ case $1 in
         ;;
     *)
         echo "Writing CSVs"
-        for id in {00..10}; do
-            for particles in $PARTICLE_COUNTS; do
-                trajectory=data/kitti/map_trajectories/${id}.txt.bz2
-                map=data/kitti/${id}.osm.bz2
-                echo "Spawning processes for $id with $particles particles"
-                child_block
-                set -x
-                $RUN --enablemapfilter "$trajectory" "$map" \
-                    --out "$DEST_DIR/${id}-map-${particles}.csv" \
-                    --particles $particles &
-                set +x
-                child_block
-                set -x
-                $RUN --enableplainfilter "$trajectory" "$map" \
-                    --out "$DEST_DIR/${id}-plain-${particles}.csv" \
-                    --particles $particles &
-                set +x
-                echo "Spawning for $id done"
-                sleep 2
-            done
-        done
-
-        wait
+        # experiment.py's default sweep covers trajectories 00-10 with
+        # 500-2000 particles, and skips any CSVs which already exist
+        $EXPERIMENT || exit 1
         scrape
         ;;
 esac
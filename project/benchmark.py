@@ -0,0 +1,159 @@
+#!/usr/bin/env python2
+
+"""Times each of the particle filter's hot paths in isolation, across a range
+of particle counts and maps, and writes the results as JSON. Every stage is
+run repeatedly and summarised by its mean and percentiles, so that a
+regression in any one stage stands out.
+
+Usage: ./benchmark.py --out bench.json"""
+
+from argparse import ArgumentParser, FileType
+from json import dump
+from platform import python_version
+from shutil import rmtree
+from sys import stdout
+from tempfile import mkdtemp
+from timeit import default_timer
+
+import numpy as np
+
+from filter import ParticleFilter
+from map import Map
+from observation import coordinate_projector
+from settings import KARLSRUHE_CENTER
+from util import make_rngs
+
+parser = ArgumentParser(description="Benchmark particle filter stages")
+parser.add_argument(
+    '--particles', type=int, nargs='+', default=[500, 1000, 2000],
+    help="Particle counts to benchmark"
+)
+parser.add_argument(
+    '--maps', type=str, nargs='+',
+    default=['data/kitti/03.osm.bz2', 'data/kitti/00.osm.bz2'],
+    help="Maps to benchmark (ideally of different sizes)"
+)
+parser.add_argument(
+    '--repeats', type=int, default=100,
+    help="Number of times to time each filter stage"
+)
+parser.add_argument(
+    '--maprepeats', type=int, default=3,
+    help="Number of times to time map construction"
+)
+parser.add_argument(
+    '--seed', type=int, default=0, help="Random seed"
+)
+parser.add_argument(
+    '--out', type=FileType('w'), default=stdout,
+    help="File to write JSON results to"
+)
+
+
+def summarise(times):
+    """Summary statistics (in seconds) for a list of timings."""
+    times = np.asarray(times)
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {
+        'repeats': len(times),
+        'mean': times.mean(),
+        'min': times.min(),
+        'p50': p50,
+        'p90': p90,
+        'p99': p99,
+        'max': times.max()
+    }
+
+
+def time_calls(call, repeats, before=None):
+    """Time repeats calls to call. If before is given, it is called (untimed)
+    before each timed call."""
+    times = []
+    for _ in xrange(repeats):
+        if before is not None:
+            before()
+        start = default_timer()
+        call()
+        times.append(default_timer() - start)
+    return summarise(times)
+
+
+def bench_filter(num_points, centre, m, repeats, rng):
+    """Time each ParticleFilter stage, with particles starting around centre
+    (which should be on a road). Yields (stage, summary) pairs."""
+    f = ParticleFilter(num_points, centre, 25, True, True, rng=rng)
+    plain_f = ParticleFilter(num_points, centre, 25, False, False, rng=rng)
+    # GPS and map updates shrink the weights, so renormalise between calls
+    normalise = f.normalise_weights
+
+    yield 'predict_imu', time_calls(
+        lambda: f.predict_imu(0.1, 10.0, 0.05), repeats
+    )
+    yield 'predict_no_imu', time_calls(
+        lambda: plain_f.predict_no_imu(0.1), repeats
+    )
+    yield 'gps_update', time_calls(
+        lambda: f.gps_update(centre, 8), repeats, normalise
+    )
+    # Predictions have carried the particles well away from centre, so start
+    # again around it: if most particles were over 15m from a road,
+    # map_update would skip the weight update that we want to time
+    f = ParticleFilter(num_points, centre, 25, True, True, rng=rng)
+    normalise = f.normalise_weights
+    yield 'map_update', time_calls(lambda: f.map_update(m), repeats, normalise)
+    yield 'resample', time_calls(f.resample, repeats)
+    yield 'state_estimate', time_calls(f.state_estimate, repeats)
+    yield 'nearest_lane_dists', time_calls(
+        lambda: m.nearest_lane_dists(f.coords), repeats
+    )
+
+
+def bench_map(path, repeats):
+    """Time map construction, with and without a warm cache, and single-point
+    distance queries. Returns the last map built along with (stage, summary)
+    pairs."""
+    proj = coordinate_projector(KARLSRUHE_CENTER)
+    results = []
+    cache_dir = mkdtemp()
+    try:
+        results.append(('map_build', time_calls(
+            lambda: Map(path, proj), repeats
+        )))
+        # First load populates the cache
+        Map(path, proj, cache_dir=cache_dir)
+        results.append(('map_load_cached', time_calls(
+            lambda: Map(path, proj, cache_dir=cache_dir), repeats
+        )))
+        m = Map(path, proj)
+    finally:
+        rmtree(cache_dir)
+
+    centre = m.segments[len(m.segments) // 2].mean(axis=0)
+    results.append(('nearest_lane_dist', time_calls(
+        lambda: m.nearest_lane_dist(centre), 100 * repeats
+    )))
+    return m, centre, results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng, = make_rngs(args.seed, 1)
+    results = []
+
+    for path in args.maps:
+        m, centre, map_results = bench_map(path, args.maprepeats)
+        info = {'map': path, 'segments': len(m.segments)}
+        for stage, summary in map_results:
+            results.append(dict(info, stage=stage, times=summary))
+
+        for num_points in args.particles:
+            info = dict(info, particles=num_points)
+            stages = bench_filter(num_points, centre, m, args.repeats, rng)
+            for stage, summary in stages:
+                results.append(dict(info, stage=stage, times=summary))
+
+    dump({
+        'python': python_version(),
+        'numpy': np.__version__,
+        'results': results
+    }, args.out, indent=2, sort_keys=True)
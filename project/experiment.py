@@ -0,0 +1,313 @@
+#!/usr/bin/env python2
+
+"""Runs a sweep of experiments in parallel, writing one CSV of filter
+estimates per (trajectory, filter type, particle count) cell, just like
+run.py --out would. Cells whose output already exists are skipped, so an
+interrupted sweep can be resumed by running the same command again.
+
+If "repetitions" is more than one, each cell is instead repeated that many
+times with independent noise, and the repetitions are run together as a
+single ParticleFilterBank. Each repetition gets its own CSV, with the
+repetition number appended to the cell's usual name.
+
+The sweep is described by an optional JSON file containing any of the keys in
+DEFAULT_SPEC. For example, {"trajectories": ["00"], "particles": [100]} runs
+the map and plain filters on trajectory 00 with 100 particles each."""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from json import load
+from multiprocessing import cpu_count
+from os import makedirs, path as osp, remove, rename
+from time import time as seconds
+
+import numpy as np
+
+from filter import ParticleFilterBank
+from noise import noisify_trajectory
+from run import StatsWriter, TheMainLoop, load_map, load_trajectory
+from run import parser as run_parser
+from util import make_rngs
+
+# Reproduces the sweep in bench_all.sh
+DEFAULT_SPEC = {
+    'trajectories': ['{:02}'.format(i) for i in xrange(11)],
+    'particles': [500, 1000, 1500, 2000],
+    'filters': ['map', 'plain'],
+    'trajectory_path': 'data/kitti/map_trajectories/{id}.txt.bz2',
+    'map_path': 'data/kitti/{id}.osm.bz2',
+    'dest_dir': 'results',
+    # Extra arguments passed to run.py for every cell
+    'run_args': [],
+    # If not null, every cell is run with this --seed, so that map and plain
+    # filters see identical noise and results can be compared across runs
+    'seed': None,
+    # Monte Carlo repetitions of each cell, which are run as one bank of
+    # filters if there are several
+    'repetitions': 1
+}
+
+# run.py options which banked runs can't honour, since they're interactive,
+# stream observations, vary the number of particles or write extra output
+BANK_UNSUPPORTED = (
+    'jose', 'gui', 'movie', 'stream', 'latencyout', 'adaptparticles',
+    'adaptive', 'enablerawgps', 'profile_out'
+)
+
+# Maps and trajectories which have already been loaded by this worker process,
+# keyed by the arguments used to load them
+_maps = {}
+_trajectories = {}
+
+parser = ArgumentParser(
+    description="Run a sweep of particle filter experiments in parallel"
+)
+parser.add_argument(
+    'spec', type=open, nargs='?', default=None,
+    help="JSON file describing the sweep (defaults to bench_all.sh's sweep)"
+)
+parser.add_argument(
+    '--workers', type=int, default=max(1, cpu_count() - 2),
+    help="Number of worker processes to use"
+)
+
+
+def make_cells(spec):
+    """Produce a (trajectory ID, filter type, particle count, output paths)
+    tuple for each cell in the sweep, with one output path per repetition.
+    Cells are ordered by trajectory so that each worker tends to reuse the
+    map and trajectory it has already loaded."""
+    repetitions = spec['repetitions']
+    assert repetitions >= 1, repetitions
+    for traj_id in spec['trajectories']:
+        for particles in spec['particles']:
+            for filter_type in spec['filters']:
+                assert filter_type in ('map', 'plain'), filter_type
+                name = '{}-{}-{}'.format(traj_id, filter_type, particles)
+                if repetitions == 1:
+                    names = [name]
+                else:
+                    names = [
+                        '{}-{}'.format(name, rep)
+                        for rep in xrange(repetitions)
+                    ]
+                out_paths = [
+                    osp.join(spec['dest_dir'], n + '.csv') for n in names
+                ]
+                yield traj_id, filter_type, particles, out_paths
+
+
+def cell_args(spec, traj_id, filter_type, particles, out_path=None):
+    """Build the run.py arguments for a single cell."""
+    argv = [
+        spec['trajectory_path'].format(id=traj_id),
+        spec['map_path'].format(id=traj_id),
+        '--enable{}filter'.format(filter_type),
+        '--particles', str(particles)
+    ] + list(spec['run_args'])
+    if out_path is not None:
+        argv += ['--out', out_path]
+    if spec['seed'] is not None:
+        argv += ['--seed', str(spec['seed'])]
+    return run_parser.parse_args(argv)
+
+
+def load_cell_inputs(args):
+    """Load the map and trajectory for a cell, reusing them if this worker has
+    loaded them already. Returns the map and the trajectory, which is None
+    for Jose's traces."""
+    map_key = (
+        args.map_path, args.jose, args.mapbackend, args.fieldres,
+        args.tilesize, args.maxtiles, args.distcache, args.distcachesize,
+        args.nomapcache, args.mapcache
+    )
+    if map_key not in _maps:
+        _maps[map_key] = load_map(args)
+
+    # Jose's traces are parsed lazily, so they can't be shared
+    trajectory = None
+    if not args.jose:
+        traj_key = (args.data_path, args.freq)
+        if traj_key not in _trajectories:
+            _trajectories[traj_key] = load_trajectory(args)
+        trajectory = _trajectories[traj_key]
+    return _maps[map_key], trajectory
+
+
+def run_bank(args, m, trajectory, out_fps):
+    """Run len(out_fps) repetitions of the run.py run described by args, each
+    with its own GPS, gyroscope and speedometer noise, as a single
+    ParticleFilterBank. Each repetition's estimates are written to the
+    corresponding file in out_fps, in the format of run.py --out. Returns the
+    number of observations processed.
+
+    Steps are as in FilterPipeline, except that the bank is started from the
+    first observation at which every repetition has a GPS fix (rather than
+    each filter from its own first fix). None of the GPS noise models begin
+    with an outage, so in practice that's the first observation."""
+    for name in BANK_UNSUPPORTED:
+        if getattr(args, name):
+            raise ValueError("--{} can't be used with repetitions".format(
+                name.replace('_', '-')
+            ))
+    have_map = args.enablemapfilter
+    assert have_map != args.enableplainfilter, \
+        "Banked runs need exactly one filter type"
+    have_imu = not args.noimu
+    assert not (args.snaptoroads and args.noimu), \
+        "--snaptoroads needs IMU data"
+    graph = m.graph if have_map and args.snaptoroads else None
+    m = m if have_map else None
+
+    repetitions = len(out_fps)
+    rngs = make_rngs(args.seed, 1 + repetitions, args.bitgenerator)
+    bank_rng, noise_rngs = rngs[0], rngs[1:]
+    noisy = [
+        noisify_trajectory(
+            trajectory, args.gpsstddev, args.speederror, args.gyrostddev,
+            rng, args.gps_noise_model
+        )
+        for rng in noise_rngs
+    ]
+    # (observations, repetitions, ...) arrays of everything the filters see
+    positions = np.stack([t.pos for t in noisy], axis=1)
+    have_fixes = ~np.isnan(positions).any(axis=2)
+    if have_imu:
+        speeds = np.column_stack([t.data['vf'] for t in noisy])
+        yaw_rates = np.column_stack([t.data['wu'] for t in noisy])
+
+    stats_writers = [
+        StatsWriter(fp, enable_map_f=have_map, enable_plain_f=not have_map)
+        for fp in out_fps
+    ]
+    obs_per_fix = max(0, int(round(args.freq / float(args.gpsfreq))))
+    gps_stddev = 8 if args.gpsstddev == 0 else args.gpsstddev
+    obs_since_fix = np.zeros((repetitions,), dtype=int)
+    bank = None
+    filters = [None] * repetitions
+
+    for step, obs in enumerate(trajectory):
+        give_fix = have_fixes[step] & (obs_since_fix >= obs_per_fix)
+        obs_since_fix = np.where(give_fix, 1, obs_since_fix + 1)
+
+        if bank is None:
+            if have_fixes[step].all():
+                bank = ParticleFilterBank(
+                    repetitions, args.particles, positions[step], 5,
+                    have_map, have_imu, args.resampler, bank_rng, graph
+                )
+                filters = [bank[rep] for rep in xrange(repetitions)]
+        else:
+            if give_fix.any():
+                stddev = gps_stddev
+                if args.useposaccuracy and 'pos_accuracy' in obs:
+                    stddev = np.hypot(stddev, obs['pos_accuracy'])
+                bank.gps_update(positions[step], stddev, give_fix)
+                bank.auto_resample()
+            if m is not None:
+                bank.map_update(m)
+                bank.auto_resample()
+            dt = obs.time - trajectory.times[step - 1]
+            if have_imu:
+                bank.predict(dt, speeds[step], yaw_rates[step])
+            else:
+                bank.predict(dt)
+
+        for stats_writer, f in zip(stats_writers, filters):
+            if have_map:
+                stats_writer.update(obs, map_f=f)
+            else:
+                stats_writer.update(obs, plain_f=f)
+
+    return len(trajectory)
+
+
+def run_cell(spec, cell):
+    """Run a single cell, writing to temporary files which are renamed into
+    place once the run has completed. Returns the cell, the time taken and
+    the number of observations processed."""
+    out_paths = cell[-1]
+    tmp_paths = [out_path + '.part' for out_path in out_paths]
+    if len(out_paths) > 1:
+        return run_bank_cell(spec, cell, tmp_paths)
+    args = cell_args(spec, *(cell[:-1] + (tmp_paths[0],)))
+
+    try:
+        m, trajectory = load_cell_inputs(args)
+        loop = TheMainLoop(args, m, trajectory)
+        start = seconds()
+        fixes = loop.run()
+        elapsed = seconds() - start
+        loop.cleanup()
+    finally:
+        args.out.close()
+
+    rename(tmp_paths[0], out_paths[0])
+    return cell, elapsed, fixes
+
+
+def run_bank_cell(spec, cell, tmp_paths):
+    """Run the repetitions of a cell as one bank (see run_bank), writing to
+    the given temporary files, which are renamed into place once the run has
+    completed. Returns as for run_cell."""
+    args = cell_args(spec, *cell[:-1])
+    m, trajectory = load_cell_inputs(args)
+    out_fps = [open(tmp_path, 'w') for tmp_path in tmp_paths]
+    try:
+        start = seconds()
+        fixes = run_bank(args, m, trajectory, out_fps)
+        elapsed = seconds() - start
+    finally:
+        for fp in out_fps:
+            fp.close()
+
+    for tmp_path, out_path in zip(tmp_paths, cell[-1]):
+        rename(tmp_path, out_path)
+    return cell, elapsed, fixes
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    spec = dict(DEFAULT_SPEC)
+    if args.spec is not None:
+        spec.update(load(args.spec))
+
+    if not osp.isdir(spec['dest_dir']):
+        makedirs(spec['dest_dir'])
+
+    cells = list(make_cells(spec))
+    todo = [
+        cell for cell in cells
+        if not all(osp.exists(out_path) for out_path in cell[-1])
+    ]
+    print("{} of {} cells already done".format(
+        len(cells) - len(todo), len(cells)
+    ))
+
+    executor = ProcessPoolExecutor(max_workers=args.workers)
+    futures = {executor.submit(run_cell, spec, cell): cell for cell in todo}
+    failures = 0
+    for done, future in enumerate(as_completed(futures), 1):
+        cell = futures[future]
+        out_paths = cell[-1]
+        label = out_paths[0]
+        if len(out_paths) > 1:
+            label += ' (+{} repetitions)'.format(len(out_paths) - 1)
+        try:
+            _, elapsed, fixes = future.result()
+        except Exception as e:
+            failures += 1
+            print("[{}/{}] {} failed: {!r}".format(
+                done, len(todo), label, e
+            ))
+            for out_path in out_paths:
+                if osp.exists(out_path + '.part'):
+                    remove(out_path + '.part')
+            continue
+        print("[{}/{}] {}: {} observations in {:.2f}s".format(
+            done, len(todo), label, fixes, elapsed
+        ))
+    executor.shutdown()
+
+    if failures:
+        raise SystemExit("{} cells failed".format(failures))
@@ -2,89 +2,325 @@
 
 import numpy as np
 
+from resampling import RESAMPLERS
+
+
+def can_fill(rng):
+    """Whether rng can write variates into an existing array with out=, which
+    numpy.random.Generator can but RandomState can't."""
+    return hasattr(np.random, 'Generator') \
+        and isinstance(rng, np.random.Generator)
+
+
+def sample_indices(n, k, rng=np.random):
+    """Choose k distinct integers from [0, n) uniformly at random. Takes O(k)
+    expected time when k is much smaller than n, unlike rng.permutation(n)[:k]
+    (or RandomState.choice without replacement), which shuffle all n."""
+    k = min(k, n)
+    chosen = np.unique(np.minimum(
+        (rng.uniform(size=k) * n).astype(np.int64), n - 1
+    ))
+    # Redrawing duplicates gives the first k distinct values of a uniform
+    # sequence, which are a uniformly random subset
+    while len(chosen) < k:
+        extra = (rng.uniform(size=k - len(chosen)) * n).astype(np.int64)
+        chosen = np.unique(np.concatenate((chosen, np.minimum(extra, n - 1))))
+    return chosen
+
+
+# Histogram bin sizes (in metres and radians) used by KLD-sampling to measure
+# how spread out the particles are
+KLD_BIN_SIZE = 2.0
+KLD_YAW_BIN_SIZE = np.pi / 9
+# KLD-sampling chooses enough particles that, with probability 1 - delta, the
+# KL divergence between the sample-based posterior and the true posterior is
+# below epsilon. KLD_Z is the upper 1 - delta quantile of the standard normal.
+KLD_EPSILON = 0.05
+KLD_Z = 2.326
+# Default lower limit on the number of particles chosen by KLD-sampling. A
+# filter with a single particle always has one effective particle, so it would
+# never resample (and hence never grow) again; the limit must be at least 2.
+KLD_MIN_POINTS = 20
+
+
+def kld_sample_count(bins, epsilon=KLD_EPSILON, z=KLD_Z):
+    """Number of samples which KLD-sampling (Fox, 2003) requires when the
+    samples drawn so far occupy the given number of histogram bins (infinite
+    for a single bin). Works elementwise on arrays of bin counts."""
+    bins = np.asarray(bins, dtype=float)
+    k = np.maximum(bins - 1, 1)
+    a = 2.0 / (9 * k)
+    needed = k / (2 * epsilon) * (1 - a + np.sqrt(a) * z) ** 3
+    # One bin's worth of samples tells us nothing about the spread, so no
+    # number of them is enough (AMCL uses its maximum sample count then)
+    return np.where(bins > 1, np.ceil(needed), np.inf)
+
 
 class ParticleFilter(object):
     def __init__(self, num_points, init_coords, init_sigma, have_map,
-                 have_imu):
+                 have_imu, resampler='multinomial', rng=None,
+                 min_points=None, max_points=None, graph=None):
         """Initialise num_points particles using an isotropic Gaussian with
         variance init_sigma and mean init_coords. If track_vel is True, the
         filter will store velocities as well as the headings and yaws which it
-        tracks normally."""
+        tracks normally. resampler names one of the schemes in
+        resampling.RESAMPLERS. All random numbers are drawn from rng (a
+        Generator or RandomState), or the global numpy.random state if it is
+        not given.
+
+        If max_points is given, each resampling step uses KLD-sampling to
+        choose a new number of particles between min_points (KLD_MIN_POINTS
+        by default, and at least 2) and max_points, based on how spread out
+        the particles are.
+
+        If graph (a graph.RoadGraph) is given, particles are kept on its roads
+        and predict moves them along the roads rather than through free
+        space. This needs IMU data."""
+        assert graph is None or have_imu, "Road graph needs IMU data"
+        if min_points is None:
+            min_points = KLD_MIN_POINTS
+        if min_points < 2:
+            raise ValueError(
+                "min_points must be at least 2, since a single particle "
+                "never resamples"
+            )
         self.num_points = num_points
+        self.min_points = min_points
+        self.max_points = max_points
+        self.resample_indices = RESAMPLERS[resampler]
+        self.rng = np.random if rng is None else rng
+        self._can_fill = can_fill(self.rng)
+        self.have_map = have_map
+        self.have_imu = have_imu
+        self.graph = graph
+
+        # All per-particle state lives in one (capacity, k) buffer, with
+        # coords, yaws, log weights and (if necessary) velocities or road
+        # positions being views onto the columns of its first num_points
+        # rows. Resampling gathers into a second buffer of the same shape and
+        # then swaps the two, so that no per-step allocations are needed.
+        self.capacity = max(num_points, max_points or 0)
+        width = 4 if have_imu else 6
+        if graph is not None:
+            width += 3
+        self._state = np.empty((self.capacity, width))
+        self._spare = np.empty_like(self._state)
+        self._alloc_scratch()
+        self._bind_views()
 
         # Particles are initialised using an isotropic Gaussian with covariance
         # matrix init_stddev * I and mean given by init_coords. Remember that
         # the matrix is stored with one (x, y) coordinate per row and
         # num_points rows.
-        self.coords = np.random.multivariate_normal(
+        self.coords[:] = self.rng.multivariate_normal(
             init_coords, init_sigma * np.eye(2), num_points
         )
 
         # Particle yaws are initialised randomly in [0, 2*pi]
-        self.yaws = np.random.uniform(0, 2*np.pi, num_points)
+        self.yaws[:] = self.rng.uniform(0, 2*np.pi, num_points)
 
-        # Particle weights are initially uniform
-        self.weights = np.ones(num_points) / num_points
+        if graph is not None:
+            self._snap(slice(None))
 
-        self.have_map = have_map
+        # Particle weights are initially uniform
+        self._uniform_weights()
 
         # Store speeds if necessary
-        self.have_imu = have_imu
         if not have_imu:
-            self.velocities = np.random.multivariate_normal(
+            self.velocities[:] = self.rng.multivariate_normal(
                 [0, 0], 5 * np.eye(2), num_points
             )
 
-    def normalise_weights(self):
-        """Ensure that weights sum to one."""
-        s = np.sum(self.weights)
-        # Prevent overflow
-        if s <= 0:
-            self.weights = np.ones_like(self.weights) / self.weights.size
+    def _bind_views(self):
+        """Point coords, yaws, log weights and velocities at the current state
+        buffer, and the scratch arrays at their buffers."""
+        n = self.num_points
+        state = self._state[:n]
+        self.coords = state[:, 0:2]
+        self.yaws = state[:, 2]
+        # Weights are kept as logarithms, so that products of many small
+        # likelihoods don't underflow. Normalised linear weights are cached
+        # in _weights (see the weights property).
+        self.log_weights = state[:, 3]
+        if not self.have_imu:
+            self.velocities = state[:, 4:6]
+        if self.graph is not None:
+            # The edge each particle is on (stored as a float, since it shares
+            # a buffer with everything else) and the distances along and to
+            # the left of the edge
+            self.edges = state[:, 4]
+            self.offsets = state[:, 5]
+            self.laterals = state[:, 6]
+
+        self._scratch = self._scratch_buf[:n]
+        self._scratch2 = self._scratch2_buf[:2 * n].reshape((n, 2))
+        self._weights = self._weights_buf[:n]
+        if self.have_imu:
+            self._noise = self._noise_buf[:2 * n].reshape((2, n))
+        else:
+            self._noise = self._noise_buf[:2 * n].reshape((n, 2))
+
+    def _alloc_scratch(self):
+        """Allocate scratch space for intermediate results and noise. Scratch
+        arrays are flat so that their leading parts stay contiguous when
+        reshaped for fewer than capacity particles."""
+        self._scratch_buf = np.empty((self.capacity,))
+        self._weights_buf = np.empty((self.capacity,))
+        self._scratch2_buf = np.empty((2 * self.capacity,))
+        self._noise_buf = np.empty((2 * self.capacity,))
+
+    def _snap(self, indices):
+        """Move the given particles to the nearest points on the road
+        graph."""
+        edges, offsets, laterals = self.graph.snap(
+            self.coords[indices], self.yaws[indices]
+        )
+        self.edges[indices] = edges
+        self.offsets[indices] = offsets
+        self.laterals[indices] = laterals
+        self.coords[indices] = self.graph.positions(edges, offsets, laterals)
+
+    def _standard_normal(self, out):
+        """Fill out with standard normal variates, without allocating if the
+        random number generator allows it."""
+        if self._can_fill:
+            self.rng.standard_normal(out=out)
         else:
-            self.weights = self.weights / s
+            out[...] = self.rng.standard_normal(out.shape)
+        return out
+
+    @property
+    def weights(self):
+        """Normalised particle weights. The array is reused, so copy it if it
+        needs to outlive the next update."""
+        self.normalise_weights()
+        return self._weights
+
+    def _uniform_weights(self):
+        """Give every particle the same weight."""
+        self.log_weights.fill(-np.log(self.num_points))
+        self._weights.fill(1.0 / self.num_points)
+        self._normalised = True
+        self._ess = float(self.num_points)
+
+    def _log_weights_changed(self):
+        """Note that log_weights have been changed by a measurement update."""
+        self._normalised = False
+        self._ess = None
+
+    def normalise_weights(self):
+        """Ensure that weights sum to one, using the log-sum-exp trick on the
+        log weights. Does nothing if they already do."""
+        if self._normalised:
+            return
+        top = self.log_weights.max()
+        if not np.isfinite(top):
+            # Every particle has been ruled out (or something has gone badly
+            # wrong), so there's nothing to go on
+            self._uniform_weights()
+            return
+        self.log_weights -= top
+        np.exp(self.log_weights, out=self._weights)
+        total = np.sum(self._weights)
+        self._weights /= total
+        self.log_weights -= np.log(total)
+        self._normalised = True
 
     def effective_particles(self):
         """Filter should resample when this quantity falls below some
-        threshold, which Gustaffson et al. (2002) recommend be set to 2N/3"""
-        sqsum = np.sum(np.square(self.weights))
-        if sqsum < 1e-15:
-            # Prevent numerical issues
-            return 0
-        return 1.0 / sqsum
+        threshold, which Gustaffson et al. (2002) recommend be set to 2N/3.
+        Cached until the weights next change."""
+        if self._ess is None:
+            weights = self.weights
+            self._ess = 1.0 / np.dot(weights, weights)
+        return self._ess
 
     def auto_resample(self):
         """Resample iff the number of effective particles drops below two
-        thirds of ``self.num_points``"""
+        thirds of ``self.num_points``. Returns whether it resampled."""
         if self.effective_particles() < 2.0 / 3.0 * self.num_points:
             self.resample()
+            return True
+        return False
 
     def resample(self):
-        """Draw ``self.num_points`` samples from distribution given by current
-        particle weights."""
+        """Draw samples from distribution given by current particle weights.
+        Draws ``self.num_points`` samples, unless KLD-sampling is enabled, in
+        which case the number of samples is chosen adaptively."""
         self.normalise_weights()
 
         # Produce a vector of indices into our coordinate, yaw and weights
         # vectors, choosing according the the probability distribution defined
         # by our current weights
-        samples = np.random.choice(
-            np.arange(self.num_points),
-            size=self.num_points,
-            replace=True,
-            p=self.weights
-        )
+        if self.max_points is None:
+            samples = self.resample_indices(self.weights, rng=self.rng)
+        else:
+            samples = self._kld_samples()
+
+        self._take(samples)
+
+    def _kld_samples(self):
+        """Choose particles to survive resampling using KLD-sampling. Rather
+        than drawing one sample at a time until enough have been drawn, this
+        draws max_points samples in random order and keeps the shortest
+        prefix which KLD-sampling would have been satisfied with."""
+        samples = self.rng.permutation(self.resample_indices(
+            self.weights, self.max_points, rng=self.rng
+        ))
+
+        # Give each sample's histogram bin a unique integer key, then count
+        # the number of bins occupied by each prefix of the samples
+        cells = np.floor(self.coords[samples] / KLD_BIN_SIZE).astype(np.int64)
+        yaw_bins = np.floor(
+            (self.yaws[samples] % (2 * np.pi)) / KLD_YAW_BIN_SIZE
+        ).astype(np.int64)
+        keys = (cells[:, 0] * (1 << 24) + cells[:, 1]) * 32 + yaw_bins
+        _, firsts = np.unique(keys, return_index=True)
+        new_bin = np.zeros(len(samples), dtype=int)
+        new_bin[firsts] = 1
+        bins = np.cumsum(new_bin)
+
+        counts = np.arange(1, len(samples) + 1)
+        enough = (counts >= kld_sample_count(bins)) \
+            & (counts >= self.min_points)
+        if enough.any():
+            return samples[:np.argmax(enough) + 1]
+        return samples
+
+    def _take(self, samples):
+        """Replace the particles with those at the given indices, which need
+        not be the same in number as the current particles, and make weights
+        uniform."""
+        num_points = len(samples)
+        if num_points > self.capacity:
+            self.capacity = num_points
+            self._spare = np.empty((num_points, self._state.shape[1]))
+            self._alloc_scratch()
 
         # Now resample from our set of particles
-        self.coords = self.coords[samples]
-        self.yaws = self.yaws[samples]
+        np.take(
+            self._state[:self.num_points], samples, axis=0,
+            out=self._spare[:num_points]
+        )
+        if self._spare.shape != self._state.shape:
+            # Buffers have just grown
+            self._state = np.empty_like(self._spare)
+        self._state, self._spare = self._spare, self._state
+        self.num_points = num_points
+        self._bind_views()
         # Force yaws to be in [0, 2pi)
         self.yaws %= 2 * np.pi
 
-        if not self.have_imu:
-            self.velocities = self.velocities[samples]
-
         # Set weights to be uniform
-        self.weights = np.ones(self.num_points) / self.num_points
+        self._uniform_weights()
+
+    def resize(self, num_points):
+        """Resample to a different number of particles. The state buffers are
+        only reallocated if they are too small."""
+        self.normalise_weights()
+        self._take(self.resample_indices(
+            self.weights, num_points, rng=self.rng
+        ))
 
     def state_estimate(self):
         """Give a best estimate for the current state of the vehicle."""
@@ -95,49 +331,70 @@ class ParticleFilter(object):
         # Angular means are tricky. Here we convert all of the yaws to unit
         # vectors, then add the unit vectors together to come up with a
         # weighted mean vector, which can then be converted to an angle.
-        yaw_xs = np.cos(self.yaws)
-        yaw_ys = np.sin(self.yaws)
-        mean_x = np.dot(self.weights, yaw_xs)
-        mean_y = np.dot(self.weights, yaw_ys)
+        mean_x = np.dot(self.weights, np.cos(self.yaws, out=self._scratch))
+        mean_y = np.dot(self.weights, np.sin(self.yaws, out=self._scratch))
         mean_yaw = np.arctan2(mean_y, mean_x).reshape((1,))
 
         return np.concatenate((coords, mean_yaw))
 
-    def gps_update(self, mean, stddev):
+    def gps_update(self, mean, stddev, cov=None):
         """Measure a GPS-like sensor reading with Cartesian coordinates given
-        by ``mean`` and uncertainty represented by an isotropic Gaussian with
-        standard deviation ``stddev``"""
+        by ``mean`` and Gaussian uncertainty. ``stddev`` is either a standard
+        deviation (for isotropic uncertainty) or a pair of standard
+        deviations along each axis. Alternatively, a full 2x2 covariance
+        matrix may be given as ``cov``, in which case ``stddev`` is
+        ignored."""
+        if cov is None:
+            var_x, var_y = np.broadcast_to(stddev, (2,)) ** 2
+            cov_xy = 0.0
+        else:
+            (var_x, cov_xy), (_, var_y) = cov
+        # Lower triangular Cholesky factor of the covariance, written out
+        l_xx = np.sqrt(var_x)
+        l_yx = cov_xy / l_xx
+        l_yy = np.sqrt(var_y - l_yx ** 2)
+
         # Scatter a handful of particles around the fix
         num_to_scatter = max(1, int(0.01 * self.num_points))
-        indices = np.random.permutation(self.num_points)[:num_to_scatter]
-        self.coords[indices] = np.random.multivariate_normal(
-            mean, stddev ** 2 * np.eye(2), num_to_scatter
-        )
-        self.yaws[indices] = np.random.uniform(0, 2 * np.pi, num_to_scatter)
+        indices = sample_indices(self.num_points, num_to_scatter, self.rng)
+        noise = self.rng.standard_normal((num_to_scatter, 2))
+        self.coords[indices, 0] = mean[0] + l_xx * noise[:, 0]
+        self.coords[indices, 1] = mean[1] + l_yx * noise[:, 0] \
+            + l_yy * noise[:, 1]
+        self.yaws[indices] = self.rng.uniform(0, 2 * np.pi, num_to_scatter)
+        if self.graph is not None:
+            self._snap(indices)
 
-        # Next, update the weights of all particles
-        precision = (np.eye(2) / (stddev ** 2))
-        diffs = self.coords - mean
-        by_precision = np.dot(precision, diffs.T).T
-        # We don't need to normalise, so these aren't exactly Gaussians
-        likelihoods = np.exp(-0.5 * np.einsum('ij,ij->i', diffs, by_precision))
-        assert likelihoods.shape == (self.num_points,), likelihoods.shape
-        self.weights *= likelihoods
+        # Next, update the weights of all particles. Whitening the offsets
+        # from the fix with the Cholesky factor turns Mahalanobis distances
+        # into squared Euclidean distances.
+        diffs = np.subtract(self.coords, mean, out=self._scratch2)
+        diffs[:, 0] /= l_xx
+        if cov_xy:
+            diffs[:, 1] -= l_yx * diffs[:, 0]
+        diffs[:, 1] /= l_yy
+        np.square(diffs, out=diffs)
+        log_likelihoods = np.sum(diffs, axis=1, out=self._scratch)
+        log_likelihoods *= -0.5
+        self.log_weights += log_likelihoods
+        self._log_weights_changed()
 
     def map_update(self, m):
         """Incorporate measurements from the Map instance m using a Cauchy-like
         PDF over distances of each particle from their nearest road
         segments."""
-        dists = np.zeros((self.num_points,))
-        for idx, point in enumerate(self.coords):
-            dists[idx] = m.nearest_lane_dist(point)
+        dists = m.nearest_lane_dists(self.coords)
         if np.percentile(dists, 5) > 15:
             # Don't bother incorporating weights if the 95%+ of particles are
             # more than 15m from a road. In that case, we can safely assume
             # that we're off the road.
             return
-        factors = 1.0 / ((1 + dists ** 2) ** 1.1)
-        self.weights *= factors
+        # Factors are 1 / (1 + dist^2)^1.1, so their logs are computed in place
+        np.square(dists, out=dists)
+        np.log1p(dists, out=dists)
+        dists *= -1.1
+        self.log_weights += dists
+        self._log_weights_changed()
 
     def predict(self, dt, *args):
         """Update the particles according to the state transition model."""
@@ -151,20 +408,50 @@ class ParticleFilter(object):
         assert self.have_imu
         # Constant. Tuning this can produce better performance in some cases.
         yaw_sigma = 0.15
-        noisy_yaws = np.random.normal(
-            yaw_diff, yaw_sigma, (self.num_points,)
-        )
-        # We're using a Gaussian because it's easy to sample from and gives
-        # values in (-inf, inf)
-        odom_noisy = np.random.normal(
-            forward_speed, abs(forward_speed) * 0.6, size=(self.num_points,)
-        )
-        noisy_odom = dt * odom_noisy
-        self.coords[:, 0] += noisy_odom * np.cos(self.yaws)
-        self.coords[:, 1] += noisy_odom * np.sin(self.yaws)
+        # One draw for both yaw and odometry noise. We're using Gaussians
+        # because they're easy to sample from and give values in (-inf, inf).
+        noisy_yaws, noisy_odom = self._standard_normal(self._noise)
+        noisy_yaws *= dt * yaw_sigma
+        noisy_yaws += dt * yaw_diff
+        noisy_odom *= dt * abs(forward_speed) * 0.6
+        noisy_odom += dt * forward_speed
+
+        if self.graph is not None:
+            self.yaws += noisy_yaws
+            self._predict_on_roads(dt, noisy_odom)
+            return
+
+        step = np.cos(self.yaws, out=self._scratch)
+        step *= noisy_odom
+        self.coords[:, 0] += step
+        step = np.sin(self.yaws, out=self._scratch)
+        step *= noisy_odom
+        self.coords[:, 1] += step
         # Don't worry about forcing yaws into [0, 2 * pi), since we'll do that
         # when we resample
-        self.yaws += dt * noisy_yaws
+        self.yaws += noisy_yaws
+
+    def _predict_on_roads(self, dt, dists):
+        """Move each particle the given distance along the road graph, picking
+        a road at random (guided by the particle's yaw) at junctions.
+        Particles also drift across the road a little, so that they can
+        change lanes."""
+        # Constant, in metres per second
+        lateral_sigma = 0.5
+        # Vehicles don't go backwards on the road graph
+        np.maximum(dists, 0, out=dists)
+        self.offsets += dists
+        edges = self.edges.astype(np.int64)
+        self.graph.advance(edges, self.offsets, self.yaws, self.rng)
+        self.edges[:] = edges
+
+        drift = self._standard_normal(self._scratch)
+        drift *= lateral_sigma * dt
+        self.laterals += drift
+        self.graph.clip_laterals(edges, self.laterals)
+        self.graph.positions(
+            edges, self.offsets, self.laterals, out=self.coords
+        )
 
     def predict_no_imu(self, dt):
         """Run predict step of PF when no IMU is available. Uses a fixed,
@@ -172,13 +459,333 @@ class ParticleFilter(object):
         # Run investigate_transitions.py for some insight into the choice of
         # covariance here. I've chosen a much larger covariance than the sample
         # covariance, since we need the particles to jump around a bit.
-        new_velocities = self.velocities + np.random.multivariate_normal(
-            [0, 0], dt * 1 * np.eye(2), len(self.velocities)
-        )
-        self.coords += 0.5 * dt * (self.velocities + new_velocities)
-        self.velocities = new_velocities
+        accel = self._standard_normal(self._noise)
+        accel *= np.sqrt(dt)
+
+        # Trapezoidal integration of old and new velocities, i.e.
+        # coords += dt * velocities + 0.5 * dt * accel
+        step = np.multiply(self.velocities, dt, out=self._scratch2)
+        self.coords += step
+        step = np.multiply(accel, 0.5 * dt, out=self._scratch2)
+        self.coords += step
+        self.velocities += accel
 
         # Keep yaws updated as well for the good of the visualisation code.
         # This can be disabled in "production"
-        self.yaws = np.arctan2(self.velocities[:, 1], self.velocities[:, 0])
+        np.arctan2(self.velocities[:, 1], self.velocities[:, 0], out=self.yaws)
         self.yaws %= 2 * np.pi
+
+
+class ParticleFilterBank(object):
+    """Runs num_filters independent particle filters of num_points particles
+    each, stored as (num_filters, num_points, ...) arrays so that every filter
+    can be stepped with a handful of vectorised operations. Useful for Monte
+    Carlo repetitions and parameter sweeps over a single trajectory (see
+    experiment.py). Every filter keeps num_points particles throughout, so
+    KLD-sampling isn't supported."""
+    def __init__(self, num_filters, num_points, init_coords, init_sigma,
+                 have_map, have_imu, resampler='multinomial', rng=None,
+                 graph=None):
+        """Arguments are as for ParticleFilter, except that init_coords may be
+        an (num_filters, 2) array giving each filter its own initial mean and
+        have_map may be a length num_filters boolean array saying which
+        filters should incorporate map measurements."""
+        assert graph is None or have_imu, "Road graph needs IMU data"
+        self.num_filters = num_filters
+        self.num_points = num_points
+        self.resample_indices = RESAMPLERS[resampler]
+        self.rng = np.random if rng is None else rng
+        self.have_map = np.empty((num_filters,), dtype=bool)
+        self.have_map[:] = have_map
+        self.have_imu = have_imu
+        self.graph = graph
+
+        width = 4 if have_imu else 6
+        if graph is not None:
+            width += 3
+        self._state = np.empty((num_filters, num_points, width))
+        self._spare = np.empty_like(self._state)
+        self._weights = np.empty((num_filters, num_points))
+        self._bind_views()
+
+        shape = (num_filters, num_points)
+        init_coords = np.asarray(init_coords, dtype=float).reshape((-1, 1, 2))
+        self.coords[:] = init_coords + np.sqrt(init_sigma) \
+            * self.rng.standard_normal(shape + (2,))
+        self.yaws[:] = self.rng.uniform(0, 2 * np.pi, shape)
+        if graph is not None:
+            self._snap(Ellipsis)
+        self._uniform_weights()
+        if not have_imu:
+            self.velocities[:] = np.sqrt(5) \
+                * self.rng.standard_normal(shape + (2,))
+
+    def _bind_views(self):
+        """Point coords, yaws, log weights and velocities or road positions
+        at the current state buffer."""
+        self.coords = self._state[..., 0:2]
+        self.yaws = self._state[..., 2]
+        # Weights are kept as logarithms, as in ParticleFilter, with
+        # normalised linear weights cached in _weights
+        self.log_weights = self._state[..., 3]
+        if not self.have_imu:
+            self.velocities = self._state[..., 4:6]
+        if self.graph is not None:
+            # As in ParticleFilter
+            self.edges = self._state[..., 4]
+            self.offsets = self._state[..., 5]
+            self.laterals = self._state[..., 6]
+
+    def _snap(self, index):
+        """Move the particles selected by index (an index into the first two
+        axes of the state) to the nearest points on the road graph."""
+        coords = self.coords[index]
+        shape = coords.shape[:-1]
+        edges, offsets, laterals = self.graph.snap(
+            coords.reshape((-1, 2)), self.yaws[index].ravel()
+        )
+        self.edges[index] = edges.reshape(shape)
+        self.offsets[index] = offsets.reshape(shape)
+        self.laterals[index] = laterals.reshape(shape)
+        self.coords[index] = self.graph.positions(
+            edges, offsets, laterals
+        ).reshape(shape + (2,))
+
+    def __getitem__(self, index):
+        return BankedFilter(self, index)
+
+    @property
+    def weights(self):
+        """(num_filters, num_points) array of normalised weights. The array
+        is reused, so copy it if it needs to outlive the next update."""
+        self.normalise_weights()
+        return self._weights
+
+    def _uniform_weights(self, which=None):
+        """Give every particle in the filters selected by the boolean array
+        which (or in every filter) the same weight."""
+        if which is None:
+            which = slice(None)
+            self._normalised = True
+            self._ess = np.empty((self.num_filters,))
+        self.log_weights[which] = -np.log(self.num_points)
+        self._weights[which] = 1.0 / self.num_points
+        if self._ess is not None:
+            self._ess[which] = self.num_points
+
+    def _log_weights_changed(self):
+        """Note that log_weights have been changed by a measurement update."""
+        self._normalised = False
+        self._ess = None
+
+    def normalise_weights(self):
+        """Ensure that the weights of each filter sum to one, using the
+        log-sum-exp trick on the log weights. Does nothing if they already
+        do."""
+        if self._normalised:
+            return
+        tops = self.log_weights.max(axis=1)
+        degenerate = ~np.isfinite(tops)
+        tops[degenerate] = 0
+        self.log_weights -= tops[:, np.newaxis]
+        np.exp(self.log_weights, out=self._weights)
+        totals = np.sum(self._weights, axis=1)
+        totals[degenerate] = 1
+        self._weights /= totals[:, np.newaxis]
+        self.log_weights -= np.log(totals)[:, np.newaxis]
+        self._normalised = True
+        if degenerate.any():
+            # As in ParticleFilter, filters which have ruled out every
+            # particle start again from uniform weights
+            self._uniform_weights(degenerate)
+
+    def effective_particles(self):
+        """Effective number of particles for each filter. Cached until the
+        weights next change."""
+        if self._ess is None:
+            weights = self.weights
+            self._ess = 1.0 / np.einsum('ij,ij->i', weights, weights)
+        return self._ess
+
+    def auto_resample(self):
+        """Resample those filters with fewer than two thirds of num_points
+        effective particles. Returns a boolean array saying which filters
+        resampled."""
+        needed = self.effective_particles() < 2.0 / 3.0 * self.num_points
+        if np.any(needed):
+            self.resample(needed)
+        return needed
+
+    def resample(self, which=None):
+        """Resample the filters selected by the boolean array which (or all
+        filters, if which is not given)."""
+        if which is None:
+            which = np.ones((self.num_filters,), dtype=bool)
+        self.normalise_weights()
+
+        # Filters which aren't being resampled just keep their particles
+        samples = np.empty((self.num_filters, self.num_points), dtype=int)
+        samples[:] = np.arange(self.num_points)
+        samples[which] = self.resample_indices(
+            self._weights[which], rng=self.rng
+        )
+        samples += self.num_points * np.arange(self.num_filters)[:, np.newaxis]
+
+        width = self._state.shape[-1]
+        np.take(
+            self._state.reshape((-1, width)), samples.ravel(), axis=0,
+            out=self._spare.reshape((-1, width))
+        )
+        self._state, self._spare = self._spare, self._state
+        self._bind_views()
+        self.yaws %= 2 * np.pi
+        self._uniform_weights(which)
+
+    def state_estimates(self):
+        """Return a (num_filters, 3) array of (x, y, yaw) estimates."""
+        weights = self.weights
+        rv = np.empty((self.num_filters, 3))
+        rv[:, :2] = np.einsum('ij,ijk->ik', weights, self.coords)
+        mean_x = np.einsum('ij,ij->i', weights, np.cos(self.yaws))
+        mean_y = np.einsum('ij,ij->i', weights, np.sin(self.yaws))
+        rv[:, 2] = np.arctan2(mean_y, mean_x)
+        return rv
+
+    def gps_update(self, mean, stddev, which=None):
+        """As ParticleFilter.gps_update with isotropic uncertainty, except
+        that mean may be an (num_filters, 2) array and stddev a length
+        num_filters array, so that each filter can be given its own fix and
+        uncertainty. If the boolean array which is given, only the filters
+        it selects are given a fix."""
+        rows = np.arange(self.num_filters)
+        if which is not None:
+            rows = rows[which]
+        if not len(rows):
+            return
+        mean = np.broadcast_to(
+            np.asarray(mean, dtype=float).reshape((-1, 2)),
+            (self.num_filters, 2)
+        )[rows, np.newaxis]
+        stddev = np.broadcast_to(stddev, (self.num_filters,))[rows]
+        stddev = stddev[:, np.newaxis]
+
+        # Scatter a handful of distinct particles in each filter around its
+        # fix
+        num_to_scatter = max(1, int(0.01 * self.num_points))
+        shape = (len(rows), num_to_scatter)
+        scattered = (rows[:, np.newaxis], np.array([
+            sample_indices(self.num_points, num_to_scatter, self.rng)
+            for _ in rows
+        ]))
+        self.coords[scattered] = mean + stddev[..., np.newaxis] \
+            * self.rng.standard_normal(shape + (2,))
+        self.yaws[scattered] = self.rng.uniform(0, 2 * np.pi, shape)
+        if self.graph is not None:
+            self._snap(scattered)
+
+        diffs = self.coords[rows] - mean
+        sq_dists = np.einsum('ijk,ijk->ij', diffs, diffs)
+        self.log_weights[rows] -= 0.5 * sq_dists / stddev ** 2
+        self._log_weights_changed()
+
+    def map_update(self, m):
+        """Incorporate measurements from the Map instance m in each filter
+        with have_map set, as in ParticleFilter.map_update. Distances for all
+        such filters are found with a single query."""
+        if not np.any(self.have_map):
+            return
+        coords = self.coords[self.have_map]
+        dists = m.nearest_lane_dists(coords.reshape((-1, 2))) \
+            .reshape(coords.shape[:2])
+        # Filters whose particles are mostly off the road are left alone
+        off_road = np.percentile(dists, 5, axis=1) > 15
+        log_factors = -1.1 * np.log1p(dists ** 2)
+        log_factors[off_road] = 0
+        self.log_weights[self.have_map] += log_factors
+        self._log_weights_changed()
+
+    def predict(self, dt, *args):
+        """Update the particles according to the state transition model."""
+        if self.have_imu:
+            return self.predict_imu(dt, *args)
+        return self.predict_no_imu(dt)
+
+    def predict_imu(self, dt, forward_speed, yaw_diff):
+        """As ParticleFilter.predict_imu, except that forward_speed and
+        yaw_diff may be length num_filters arrays."""
+        assert self.have_imu
+        yaw_sigma = 0.15
+        forward_speed = np.asarray(forward_speed, dtype=float).reshape((-1, 1))
+        yaw_diff = np.asarray(yaw_diff, dtype=float).reshape((-1, 1))
+        shape = (self.num_filters, self.num_points)
+        noisy_yaws = yaw_diff + yaw_sigma * self.rng.standard_normal(shape)
+        noisy_odom = dt * (forward_speed + np.abs(forward_speed) * 0.6
+                           * self.rng.standard_normal(shape))
+        if self.graph is not None:
+            self.yaws += dt * noisy_yaws
+            self._predict_on_roads(dt, noisy_odom)
+            return
+        self.coords[..., 0] += noisy_odom * np.cos(self.yaws)
+        self.coords[..., 1] += noisy_odom * np.sin(self.yaws)
+        self.yaws += dt * noisy_yaws
+
+    def _predict_on_roads(self, dt, dists):
+        """As ParticleFilter._predict_on_roads, for every filter at once."""
+        lateral_sigma = 0.5
+        shape = self.edges.shape
+        # The road graph works on flat arrays, so positions are copied out of
+        # the state buffer and back again
+        edges = self.edges.astype(np.int64).ravel()
+        offsets = (self.offsets + np.maximum(dists, 0)).ravel()
+        self.graph.advance(edges, offsets, self.yaws.ravel(), self.rng)
+        laterals = (self.laterals + lateral_sigma * dt
+                    * self.rng.standard_normal(shape)).ravel()
+        self.graph.clip_laterals(edges, laterals)
+        self.edges[:] = edges.reshape(shape)
+        self.offsets[:] = offsets.reshape(shape)
+        self.laterals[:] = laterals.reshape(shape)
+        self.coords[:] = self.graph.positions(
+            edges, offsets, laterals
+        ).reshape(shape + (2,))
+
+    def predict_no_imu(self, dt):
+        """As ParticleFilter.predict_no_imu, for every filter at once."""
+        accel = np.sqrt(dt) * self.rng.standard_normal(self.velocities.shape)
+        self.coords += dt * self.velocities + 0.5 * dt * accel
+        self.velocities += accel
+        np.arctan2(
+            self.velocities[..., 1], self.velocities[..., 0], out=self.yaws
+        )
+        self.yaws %= 2 * np.pi
+
+
+class BankedFilter(object):
+    """View of a single filter in a ParticleFilterBank, exposing enough of the
+    ParticleFilter interface for StatsWriter and MapDisplay."""
+    def __init__(self, bank, index):
+        self.bank = bank
+        self.index = index
+        self.num_points = bank.num_points
+        self.have_map = bank.have_map[index]
+        self.have_imu = bank.have_imu
+
+    @property
+    def coords(self):
+        return self.bank.coords[self.index]
+
+    @property
+    def yaws(self):
+        return self.bank.yaws[self.index]
+
+    @property
+    def weights(self):
+        return self.bank.weights[self.index]
+
+    def state_estimate(self):
+        weights = self.weights
+        coords = np.dot(weights, self.coords)
+        mean_yaw = np.arctan2(
+            np.dot(weights, np.sin(self.yaws)),
+            np.dot(weights, np.cos(self.yaws))
+        )
+        return np.append(coords, mean_yaw)
@@ -0,0 +1,194 @@
+"""Road network topology, for keeping particles on roads and moving them
+along them."""
+
+import numpy as np
+
+from spatial import SegmentIndex, project_onto_segments
+
+
+# How strongly particles prefer roads which continue in the direction that
+# they're heading when choosing which way to go at a junction. Candidate
+# roads are weighted by exp(BRANCH_CONCENTRATION * cos(angle)), as in a von
+# Mises distribution.
+BRANCH_CONCENTRATION = 4.0
+
+
+class RoadGraph(object):
+    """Directed graph of road centrelines. Nodes are points shared by ways
+    (so junctions are nodes with several outgoing edges), and edges are the
+    straight pieces of each way between consecutive nodes. Two-way roads have
+    an edge in each direction.
+
+    Points on roads are given by an edge, an offset (distance along the
+    edge) and a lateral offset (distance to the left of the centreline, which
+    is at most half the road's width).
+
+    Outgoing edges are stored in compressed sparse row form: edges are sorted
+    by the node they leave from, and the edges leaving node v are those with
+    indices edge_ptr[v] to edge_ptr[v + 1]."""
+    def __init__(self, node_xy, way_node_ptr, way_nodes, way_oneway,
+                 way_width):
+        """Build the graph from an (V, 2) array of node positions and a list of
+        ways, also in compressed sparse row form: the nodes of way i (in
+        order) are way_nodes[way_node_ptr[i]:way_node_ptr[i + 1]],
+        way_oneway[i] says whether the way can only be travelled in that
+        order and way_width[i] is its width in metres."""
+        self.node_xy = np.asarray(node_xy, dtype=float).reshape((-1, 2))
+        way_node_ptr = np.asarray(way_node_ptr, dtype=np.int64)
+        way_nodes = np.asarray(way_nodes, dtype=np.int64)
+        way_oneway = np.asarray(way_oneway, dtype=bool)
+        way_width = np.asarray(way_width, dtype=float)
+
+        # Consecutive nodes make an edge, except across the boundaries
+        # between ways
+        sizes = np.diff(way_node_ptr)
+        way_of_node = np.repeat(np.arange(len(sizes)), sizes)
+        joined = way_of_node[:-1] == way_of_node[1:]
+        froms = way_nodes[:-1][joined]
+        tos = way_nodes[1:][joined]
+        edge_ways = way_of_node[:-1][joined]
+        # Repeated nodes would give zero-length edges
+        distinct = np.any(self.node_xy[froms] != self.node_xy[tos], axis=1)
+        froms, tos = froms[distinct], tos[distinct]
+        edge_ways = edge_ways[distinct]
+        oneway = way_oneway[edge_ways]
+
+        # Add reverse edges for two-way roads, remembering which edge is
+        # which's reverse
+        num_fwd = len(froms)
+        back = np.flatnonzero(~oneway)
+        all_froms = np.concatenate((froms, tos[back]))
+        all_tos = np.concatenate((tos, froms[back]))
+        all_ways = np.concatenate((edge_ways, edge_ways[back]))
+        reverse = np.full(len(all_froms), -1, dtype=np.int64)
+        reverse[back] = num_fwd + np.arange(len(back))
+        reverse[num_fwd:] = back
+
+        order = np.argsort(all_froms, kind='mergesort')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.edge_from = all_froms[order]
+        self.edge_to = all_tos[order]
+        self.edge_half_width = 0.5 * way_width[all_ways[order]]
+        self.edge_reverse = np.where(
+            reverse[order] >= 0, rank[reverse[order]], -1
+        )
+        self.edge_ptr = np.searchsorted(
+            self.edge_from, np.arange(len(self.node_xy) + 1)
+        )
+
+        self.edge_begin = self.node_xy[self.edge_from]
+        self.edge_delta = self.node_xy[self.edge_to] - self.edge_begin
+        self.edge_length = np.sqrt(
+            np.einsum('ij,ij->i', self.edge_delta, self.edge_delta)
+        )
+        self.edge_heading = np.arctan2(
+            self.edge_delta[:, 1], self.edge_delta[:, 0]
+        )
+        # Unit vectors pointing to the left of each edge
+        self.edge_normal = np.column_stack((
+            -self.edge_delta[:, 1], self.edge_delta[:, 0]
+        )) / self.edge_length[:, np.newaxis]
+        self._index = None
+
+    def __len__(self):
+        """Number of (directed) edges."""
+        return len(self.edge_from)
+
+    def positions(self, edges, offsets, laterals, out=None):
+        """Positions of points which are the given distances along and to the
+        left of the given edges."""
+        frac = offsets / self.edge_length[edges]
+        out = np.multiply(
+            self.edge_delta[edges], frac[:, np.newaxis], out=out
+        )
+        out += self.edge_begin[edges]
+        out += self.edge_normal[edges] * laterals[:, np.newaxis]
+        return out
+
+    def clip_laterals(self, edges, laterals):
+        """Keep lateral offsets within the width of their roads, in place."""
+        half_widths = self.edge_half_width[edges]
+        np.clip(laterals, -half_widths, half_widths, out=laterals)
+
+    def snap(self, points, yaws):
+        """Find the nearest point on the road network to each of the (N, 2)
+        points given, counting anywhere within the width of a road as on it.
+        Returns the edge, offset and lateral offset of each nearest point.
+        Where a road goes both ways, the edge facing closest to the
+        corresponding yaw is chosen."""
+        if self._index is None:
+            self._index = SegmentIndex(np.stack(
+                (self.edge_begin, self.edge_begin + self.edge_delta), axis=1
+            ))
+        _, edges = self._index.query(points)
+        _, t = project_onto_segments(
+            points, self.edge_begin[edges],
+            self.edge_begin[edges] + self.edge_delta[edges]
+        )
+        offsets = t * self.edge_length[edges]
+        laterals = np.einsum(
+            'ij,ij->i', points - self.edge_begin[edges],
+            self.edge_normal[edges]
+        )
+        self.clip_laterals(edges, laterals)
+
+        backwards = (np.cos(self.edge_heading[edges] - yaws) < 0) \
+            & (self.edge_reverse[edges] >= 0)
+        offsets[backwards] = self.edge_length[edges[backwards]] \
+            - offsets[backwards]
+        laterals[backwards] *= -1
+        edges[backwards] = self.edge_reverse[edges[backwards]]
+        return edges, offsets, laterals
+
+    def advance(self, edges, offsets, yaws, rng=np.random):
+        """Move points which have been pushed past the end of their edges
+        (i.e. whose offsets are greater than their edges' lengths) on to
+        subsequent edges, choosing a branch at random at each junction. Points
+        which reach a dead end stop there. Modifies edges and offsets in
+        place."""
+        moving = np.flatnonzero(offsets > self.edge_length[edges])
+        while moving.size:
+            offsets[moving] -= self.edge_length[edges[moving]]
+            next_edges = self.choose_next(edges[moving], yaws[moving], rng)
+            stuck = next_edges < 0
+            offsets[moving[stuck]] = self.edge_length[edges[moving[stuck]]]
+            edges[moving[~stuck]] = next_edges[~stuck]
+            moving = moving[~stuck]
+            moving = moving[offsets[moving] > self.edge_length[edges[moving]]]
+
+    def choose_next(self, edges, yaws, rng=np.random):
+        """Randomly choose an edge to follow on from each of the given edges,
+        preferring those which continue in the direction of the corresponding
+        yaw (see BRANCH_CONCENTRATION). Roads are only followed back the way
+        they came at dead ends. Returns -1 for edges which have no
+        successor."""
+        nodes = self.edge_to[edges]
+        starts = self.edge_ptr[nodes]
+        degrees = self.edge_ptr[nodes + 1] - starts
+
+        # Lay out every candidate for every edge contiguously
+        owner = np.repeat(np.arange(len(edges)), degrees)
+        group_ends = np.cumsum(degrees)
+        group_starts = group_ends - degrees
+        cands = np.arange(owner.size) - group_starts[owner] + starts[owner]
+
+        scores = np.exp(BRANCH_CONCENTRATION * np.cos(
+            self.edge_heading[cands] - yaws[owner]
+        ))
+        u_turn = (cands == self.edge_reverse[edges[owner]]) \
+            & (degrees[owner] > 1)
+        scores[u_turn] = 0
+
+        # Inverse CDF sampling within each group of candidates
+        cum_scores = np.cumsum(scores)
+        before = np.concatenate(([0], cum_scores))[group_starts]
+        totals = np.concatenate(([0], cum_scores))[group_ends] - before
+        targets = before + rng.uniform(size=len(edges)) * totals
+        picks = np.searchsorted(cum_scores, targets, side='right')
+        picks = np.clip(picks, group_starts, group_ends - 1)
+
+        rv = np.full(len(edges), -1, dtype=np.int64)
+        live = degrees > 0
+        rv[live] = cands[picks[live]]
+        return rv
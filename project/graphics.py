@@ -97,9 +97,10 @@ class MapDisplay(object):
         min_x = min_y = float('inf')
         max_x = max_y = float('-inf')
 
+        weights = f.weights
         for i in xrange(f.num_points):
             coords = f.coords[i]
-            weight = f.weights[i]
+            weight = weights[i]
             yaw = f.yaws[i]
 
             # Update maxima
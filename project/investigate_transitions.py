@@ -13,7 +13,7 @@ from matplotlib import pyplot as plt
 
 import numpy as np
 
-from observation import parse_map_trajectory
+from observation import DATA_HEADERS, load_map_trajectory
 
 if __name__ == '__main__':
     assert len(argv) > 1, "Need at least one input file"
@@ -27,13 +27,15 @@ if __name__ == '__main__':
             trajectory_fp = open(filename, 'rb')
 
         try:
-            traj = list(parse_map_trajectory(trajectory_fp))
+            traj = load_map_trajectory(trajectory_fp)
         finally:
             trajectory_fp.close()
 
-        for past, present in zip(traj, traj[1:]):
-            for key in past.data.iterkeys():
-                pairs[key].append((past[key], present[key]))
+        for key in DATA_HEADERS:
+            column = traj.data[key]
+            pairs[key].append(np.column_stack((column[:-1], column[1:])))
+
+    pairs = {key: np.concatenate(value) for key, value in pairs.iteritems()}
 
     vf_pairs = np.array(pairs['vf'])
     vf_now = vf_pairs[:, 0]
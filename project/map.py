@@ -1,15 +1,31 @@
 """Functions and classes for manipulating OpenStreetMap data."""
 
+from hashlib import sha1
+from os import makedirs, path as osp, rename, stat
+from shutil import rmtree
+from tempfile import mkdtemp
+
 import numpy as np
 
 from imposm.parser import OSMParser
 
-from CGAL.CGAL_AABB_tree import AABB_tree_Segment_3_soup
-from CGAL.CGAL_Kernel import Segment_3, Point_3
+# CGAL's SWIG bindings aren't on PyPI, so they're optional. They're only used
+# for single point lane distance queries on maps whose batched index is
+# approximate; otherwise (or without CGAL) a SegmentIndex answers those.
+try:
+    from CGAL.CGAL_AABB_tree import AABB_tree_Segment_3_soup
+    from CGAL.CGAL_Kernel import Segment_3, Point_3
+    HAVE_CGAL = True
+except ImportError:
+    HAVE_CGAL = False
 
 from scipy.io import loadmat
 
+from graph import RoadGraph
 from settings import DEFAULT_LANE_WIDTH
+from spatial import (
+    DistanceCache, DistanceField, SegmentIndex, TiledSegmentIndex
+)
 
 
 # These are all the most important road types. Some types have been ommitted in
@@ -22,68 +38,301 @@ ROAD_TYPES = frozenset([
 ])
 
 
+# Bump this whenever the format of compiled maps changes, or the way in which
+# they are compiled changes, so that stale cache entries are ignored
+COMPILED_MAP_VERSION = 4
+
+# Arrays stored in each compiled map directory
+COMPILED_MAP_ARRAYS = (
+    'segments', 'way_ids', 'lane_ids', 'reference_coords', 'node_xy',
+    'way_node_ptr', 'way_nodes', 'way_oneway', 'way_width'
+)
+
+# Values of the OpenStreetMap oneway tag which mean that a way may only be
+# travelled in the order of its nodes, or only in reverse
+ONEWAY_FORWARD = frozenset(['yes', 'true', '1'])
+ONEWAY_REVERSE = frozenset(['-1', 'reverse'])
+
+
+def compiled_map_key(path, projector, kind, by_content=True):
+    """Cache key for a compiled map of the given kind (usually a class name)
+    read from path and projected with projector. If by_content is False, the
+    file is identified by its absolute path, size and modification time
+    rather than by hashing it, so that the key can be computed without
+    reading the whole file."""
+    h = sha1()
+    if by_content:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        info = stat(path)
+        h.update(repr((
+            osp.abspath(path), info.st_size, info.st_mtime
+        )).encode('utf8'))
+    h.update(repr((
+        COMPILED_MAP_VERSION, kind, tuple(projector.reference_coords),
+        DEFAULT_LANE_WIDTH
+    )).encode('utf8'))
+    return h.hexdigest()
+
+
 def perp(begin, end):
     """Return a 2D unit vector orthogonal to the line defined by the two 2D
-    vectors begin and end"""
-    proj_matrix = np.array([[0, -1], [1, 0]])
-    delta = end - begin
-    return np.dot(proj_matrix, delta) / np.linalg.norm(delta)
+    vectors begin and end. Also works on (N, 2) arrays of vectors, giving an
+    (N, 2) array of unit vectors."""
+    delta = np.asarray(end) - np.asarray(begin)
+    orth = np.stack((-delta[..., 1], delta[..., 0]), axis=-1)
+    return orth / np.linalg.norm(delta, axis=-1)[..., np.newaxis]
 
 
 class Map(object):
     """Class representing all of the roads in an OpenStreetMap map."""
-    def __init__(self, path, projector):
+    def __init__(self, path, projector, field_resolution=None,
+                 cache_dir=None, tile_size=None, max_tiles=64,
+                 dist_cell_size=None, dist_cache_size=1 << 16):
         """Takes a path to an OpenStreetMap map (tested with XML format) and
         initialises a Map instance containing all of the data therein.
         Projector will be a function to project (lat, lon) coordinates into
-        something more tractable."""
-        self.segments = []
-        self._node_loc = {}
-        self._way_refs = {}
-        self._way_tags = {}
-        p = OSMParser(
-            coords_callback=self._handle_coords,
-            ways_callback=self._handle_ways
+        something more tractable. If field_resolution is given, batched lane
+        distance queries will be answered approximately from a precomputed
+        distance field with that resolution (in metres).
+
+        If cache_dir is given, the compiled map (segments, lane metadata, road
+        graph and any distance field) will be saved there and memory mapped
+        on subsequent loads of the same file with the same projection.
+
+        If tile_size is given, lane distance queries will instead be answered
+        from tiles of that size (in metres) stored in cache_dir, at most
+        max_tiles of which are kept in memory at once. This is meant for maps
+        too large to index all at once, so the cache key is based on the
+        file's path, size and modification time rather than its contents,
+        keeping startup time independent of the map's size. Distances (from
+        nearest_lane_dist too) are only exact up to the tiles' margin of 50
+        metres; see TiledSegmentIndex.
+
+        If dist_cell_size is given, batched lane distance queries go through
+        a DistanceCache (available as self.dist_cache) with that cell size and
+        dist_cache_size slots. A cell size of zero only removes duplicate
+        points from each batch, leaving distances exact."""
+        self.reference_coords = np.array(projector.reference_coords)
+        compiled_dir = None
+        if cache_dir is not None:
+            key = compiled_map_key(
+                path, projector, type(self).__name__, tile_size is None
+            )
+            compiled_dir = osp.join(cache_dir, key)
+
+        if compiled_dir is not None and osp.isdir(compiled_dir):
+            self._load_compiled(compiled_dir)
+        else:
+            self._compile(path, projector)
+            self.segments = np.asarray(self.segments, dtype=float) \
+                .reshape((-1, 2, 2))
+            self.way_ids = np.asarray(self.way_ids, dtype=np.int64)
+            self.lane_ids = np.asarray(self.lane_ids, dtype=np.int32)
+            if compiled_dir is not None:
+                self._save_compiled(compiled_dir)
+
+        self._graph = None
+        if tile_size is not None:
+            if compiled_dir is None:
+                raise ValueError("Tiled maps need a cache directory")
+            tile_dir = osp.join(compiled_dir, 'tiles-{}'.format(tile_size))
+            if not TiledSegmentIndex.exists(tile_dir):
+                TiledSegmentIndex.build(self.segments, tile_dir, tile_size)
+            self._lane_index = TiledSegmentIndex(tile_dir, max_tiles)
+            # Building an AABB tree (or any index) over the whole map is
+            # exactly what tiling is meant to avoid
+            self._aabb_tree = None
+            self._exact_index = self._lane_index
+        else:
+            self._build_index(field_resolution, compiled_dir)
+
+        self.dist_cache = None
+        if dist_cell_size is not None:
+            self.dist_cache = DistanceCache(
+                self._lane_index, dist_cell_size, dist_cache_size
+            )
+
+    @property
+    def graph(self):
+        """RoadGraph of this map, which is built the first time it's
+        needed."""
+        if self._graph is None:
+            self._graph = RoadGraph(
+                self.node_xy, self.way_node_ptr, self.way_nodes,
+                self.way_oneway, self.way_width
+            )
+        return self._graph
+
+    def _compile(self, path, projector):
+        """Read the map at path, filling in self.segments along with the
+        OpenStreetMap way ID and lane number of each segment (self.way_ids
+        and self.lane_ids). Also fills in the arrays needed to build a
+        RoadGraph: the position of each node used by a way (self.node_xy),
+        the nodes of each way (self.way_node_ptr and self.way_nodes), whether
+        each way is one-way (self.way_oneway) and its width
+        (self.way_width). Ways which refer to nodes missing from the file
+        are split at the missing nodes, and each piece is stored as a way of
+        its own in these arrays."""
+        # First pass: collect highways, and hence the IDs of the nodes which
+        # we need coordinates for. Ways are stored in compressed sparse row
+        # form, with their refs accumulated as int64 arrays (one per batch
+        # from the parser) rather than lists of Python ints.
+        self._way_id_chunks = []
+        self._way_size_chunks = []
+        self._ref_chunks = []
+        self._way_oneway_tags = []
+        self._way_lanes_tags = []
+        OSMParser(ways_callback=self._handle_ways).parse(path)
+        osm_way_ids = np.concatenate(self._way_id_chunks + [[]]) \
+            .astype(np.int64)
+        way_sizes = np.concatenate(self._way_size_chunks + [[]]) \
+            .astype(np.int64)
+        refs = np.concatenate(self._ref_chunks + [[]]).astype(np.int64)
+        oneway_tags = self._way_oneway_tags
+        lanes_tags = self._way_lanes_tags
+        del self._way_id_chunks, self._way_size_chunks, self._ref_chunks
+        del self._way_oneway_tags, self._way_lanes_tags
+
+        # Second pass: keep coordinates for the referenced nodes only, as a
+        # sorted array of IDs and a matching array of (lat, lon) pairs
+        self._wanted_nodes = np.unique(refs)
+        self._node_id_chunks = []
+        self._lat_lon_chunks = []
+        OSMParser(coords_callback=self._handle_coords).parse(path)
+        node_ids = np.concatenate(self._node_id_chunks + [[]]) \
+            .astype(np.int64)
+        lat_lons = np.concatenate(
+            self._lat_lon_chunks + [np.empty((0, 2))]
         )
-        p.parse(path)
-
-        # Now we can resolve these into segments
-        for way_id, refs in self._way_refs.iteritems():
-            # First, estimate the number of lanes
-            num_lanes = 2
-            tags = self._way_tags[way_id]
-
-            if tags.get('oneway', None) == 'yes':
-                num_lanes = 1
-
-            if 'lanes' in tags:
-                num_lanes = max(1, int(tags['lanes']))
-
-            # Next, estimate lane width
-            lane_width = DEFAULT_LANE_WIDTH
-            # TODO: More accurate estimates
-
-            # Join each pair of refs into a segment
-            for begin_ref, end_ref in zip(refs, refs[1:]):
-                begin = self._node_loc[begin_ref]
-                end = self._node_loc[end_ref]
-                proj_begin = projector(begin)
-                proj_end = projector(end)
-
-                orth = perp(proj_begin, proj_end)
-                midpoint = (proj_begin, proj_end)
-
-                lanes = []
-                # Half the distance between the outmost lane centrelines
-                all_offset = -1 * (num_lanes - 1) * lane_width / 2.0
-                for i in xrange(num_lanes):
-                    offset = all_offset + i * lane_width
-                    lanes.append(midpoint + orth * offset)
-
-                for lane in lanes:
-                    self.segments.append(lane)
-
-        self._build_aabb_tree()
+        del self._wanted_nodes, self._node_id_chunks, self._lat_lon_chunks
+        order = np.argsort(node_ids)
+        node_ids = node_ids[order]
+        lat_lons = lat_lons[order]
+
+        # Project every node used by a way in one go, then resolve refs into
+        # indices into node_xy
+        self.node_xy = projector(lat_lons)
+        ref_nodes = np.searchsorted(node_ids, refs)
+        found = ref_nodes < len(node_ids)
+        found[found] = node_ids[ref_nodes[found]] == refs[found]
+        ref_way = np.repeat(np.arange(len(way_sizes)), way_sizes)
+
+        # Consecutive refs within a way are joined by a road, unless either
+        # is to a node missing from the file (as happens at the edges of
+        # extracts). Missing nodes split ways into pieces, each of which is a
+        # run of joined refs.
+        joined = (ref_way[:-1] == ref_way[1:]) & found[:-1] & found[1:]
+        piece_starts = found.copy()
+        piece_starts[1:] &= ~joined
+        ref_piece = np.cumsum(piece_starts)[found] - 1
+        piece_way = ref_way[piece_starts]
+        piece_sizes = np.bincount(ref_piece, minlength=len(piece_way))
+        piece_ptr = np.concatenate(([0], np.cumsum(piece_sizes)))
+
+        # Ways tagged as running against the order of their nodes are stored
+        # reversed in the road graph
+        reverse = np.array(
+            [tag in ONEWAY_REVERSE for tag in oneway_tags], dtype=bool
+        )
+        forward = np.array(
+            [tag in ONEWAY_FORWARD for tag in oneway_tags], dtype=bool
+        )
+        graph_order = np.arange(len(ref_piece))
+        flip = reverse[piece_way[ref_piece]]
+        graph_order[flip] = piece_ptr[ref_piece[flip]] \
+            + piece_ptr[ref_piece[flip] + 1] - 1 - graph_order[flip]
+
+        # Estimate the number of lanes, and hence the width, of each way
+        num_lanes = np.array([
+            1 if tag == 'yes' else 2 for tag in oneway_tags
+        ], dtype=np.int64)
+        for w, lanes in enumerate(lanes_tags):
+            if lanes is not None:
+                num_lanes[w] = max(1, int(lanes))
+        lane_width = DEFAULT_LANE_WIDTH
+        # TODO: More accurate estimates
+
+        # Make each pair of joined refs into a segment, and then offset each
+        # segment once for each of its way's lanes
+        pair_way = ref_way[:-1][joined]
+        begins = self.node_xy[ref_nodes[:-1][joined]]
+        ends = self.node_xy[ref_nodes[1:][joined]]
+        orths = perp(begins, ends)
+        pair_lanes = num_lanes[pair_way]
+        seg_pair = np.repeat(np.arange(len(pair_way)), pair_lanes)
+        # Lanes are numbered from 0 within each pair
+        self.lane_ids = np.arange(len(seg_pair)) \
+            - np.repeat(np.cumsum(pair_lanes) - pair_lanes, pair_lanes)
+        # Half the distance between the outmost lane centrelines
+        all_offsets = -1 * (pair_lanes[seg_pair] - 1) * lane_width / 2.0
+        offsets = all_offsets + self.lane_ids * lane_width
+        shifts = orths[seg_pair] * offsets[:, np.newaxis]
+        self.segments = np.stack(
+            (begins[seg_pair] + shifts, ends[seg_pair] + shifts), axis=1
+        )
+        self.way_ids = osm_way_ids[pair_way[seg_pair]]
+
+        self.way_node_ptr = piece_ptr.astype(np.int64)
+        self.way_nodes = ref_nodes[found][graph_order].astype(np.int64)
+        self.way_oneway = (forward | reverse)[piece_way]
+        self.way_width = num_lanes[piece_way] * float(lane_width)
+
+    def _save_compiled(self, compiled_dir):
+        """Write compiled map arrays to compiled_dir. The directory is written
+        under a temporary name and then renamed, so concurrent runs never see
+        a partial map."""
+        parent = osp.dirname(compiled_dir)
+        if not osp.isdir(parent):
+            try:
+                makedirs(parent)
+            except OSError:
+                # Somebody else may have just created it
+                if not osp.isdir(parent):
+                    raise
+        tmp_dir = mkdtemp(dir=parent)
+        for name in COMPILED_MAP_ARRAYS:
+            np.save(osp.join(tmp_dir, name + '.npy'), getattr(self, name))
+        try:
+            rename(tmp_dir, compiled_dir)
+        except OSError:
+            # Another process beat us to it
+            rmtree(tmp_dir)
+
+    def _load_compiled(self, compiled_dir):
+        for name in COMPILED_MAP_ARRAYS:
+            array = np.load(
+                osp.join(compiled_dir, name + '.npy'), mmap_mode='r'
+            )
+            setattr(self, name, array)
+
+    def _build_index(self, field_resolution=None, compiled_dir=None):
+        """Build the spatial indices used to answer nearest lane queries. If
+        compiled_dir is given, the distance field (if any) will be cached
+        there."""
+        # Exact index for single point queries. If the batched index is
+        # approximate, this (or an AABB tree, if we have CGAL) is only built
+        # when the first such query is made.
+        self._exact_index = None
+        self._aabb_tree = None
+        if field_resolution is None:
+            self._lane_index = SegmentIndex(self.segments)
+            self._exact_index = self._lane_index
+        elif compiled_dir is None:
+            self._lane_index = DistanceField(self.segments, field_resolution)
+        else:
+            prefix = osp.join(
+                compiled_dir, 'field-{}'.format(field_resolution)
+            )
+            if osp.exists(prefix + '-field.npy'):
+                self._lane_index = DistanceField.load(prefix)
+            else:
+                self._lane_index = DistanceField(
+                    self.segments, field_resolution
+                )
+                self._lane_index.save(prefix)
 
     def _build_aabb_tree(self):
         """Build an AABB tree from self.segments"""
@@ -98,40 +347,80 @@ class Map(object):
         assert self._aabb_tree.accelerate_distance_queries()
 
     def _handle_ways(self, ways):
-        rejected = set()
-        for id, tags, refs in ways:
-            if not refs or 'highway' not in tags:
+        ids = []
+        sizes = []
+        refs = []
+        for id, tags, way_refs in ways:
+            if not way_refs or 'highway' not in tags:
                 continue
 
             if tags['highway'] not in ROAD_TYPES:
-                rejected.add(tags['highway'])
                 continue
 
-            self._way_refs[id] = refs
-            self._way_tags[id] = tags
+            ids.append(id)
+            sizes.append(len(way_refs))
+            refs.extend(way_refs)
+            # Only keep the tags we need
+            self._way_oneway_tags.append(tags.get('oneway', None))
+            self._way_lanes_tags.append(tags.get('lanes', None))
+
+        self._way_id_chunks.append(np.array(ids, dtype=np.int64))
+        self._way_size_chunks.append(np.array(sizes, dtype=np.int64))
+        self._ref_chunks.append(np.array(refs, dtype=np.int64))
 
     def _handle_coords(self, coords):
-        for coord in coords:
-            # Yes, imposm.parser gives us coordinates in (lon, lat) format. I
-            # don't know why.
-            id, lon, lat = coord
-            self._node_loc[id] = (lat, lon)
+        if not coords:
+            return
+        ids = np.fromiter(
+            (coord[0] for coord in coords), dtype=np.int64, count=len(coords)
+        )
+        wanted = self._wanted_nodes
+        pos = np.searchsorted(wanted, ids)
+        keep = pos < len(wanted)
+        keep[keep] = wanted[pos[keep]] == ids[keep]
+        if not keep.any():
+            return
+        # Yes, imposm.parser gives us coordinates in (lon, lat) format. I
+        # don't know why.
+        lon_lats = np.array(coords, dtype=float)[keep, 1:]
+        self._node_id_chunks.append(ids[keep])
+        self._lat_lon_chunks.append(lon_lats[:, ::-1])
 
     def nearest_lane_dist(self, point):
+        """Distance from point to the nearest lane. This is exact, except for
+        tiled maps, where distances greater than the tiles' margin aren't
+        (see TiledSegmentIndex)."""
+        if self._exact_index is None and self._aabb_tree is None:
+            if HAVE_CGAL:
+                self._build_aabb_tree()
+            else:
+                self._exact_index = SegmentIndex(self.segments)
+        if self._exact_index is not None:
+            return self._exact_index.dists(point)[0]
         x, y = point
         p = Point_3(x, y, 0)
         nearest = self._aabb_tree.closest_point(p)
         return np.sqrt((x - nearest.x())**2 + (y - nearest.y())**2)
 
+    def nearest_lane_dists(self, points):
+        """Vectorised version of nearest_lane_dist. Takes an (N, 2) array of
+        points and returns an (N,) array of distances to the nearest lane."""
+        if self.dist_cache is not None:
+            return self.dist_cache.dists(points)
+        return self._lane_index.dists(points)
+
 
 class JoseMap(Map):
     """Map subclass dedicated to loading Jose's GPS trace maps"""
-    def __init__(self, path, projector):
+    def _compile(self, path, projector):
         m = loadmat(path)
         matlab_roads = m['roads']
         self.segments = []
+        self.way_ids = []
+        self.lane_ids = []
+        road_points = []
 
-        for matlab_line in matlab_roads:
+        for road_id, matlab_line in enumerate(matlab_roads):
             lats, = matlab_line['Y']
             lons, = matlab_line['X']
             # TODO: Check out road type to figure out lane count!
@@ -141,11 +430,25 @@ class JoseMap(Map):
             assert np.isnan(lons[nan_mask]).all()
             sane_lats = lats[~nan_mask]
             sane_lons = lons[~nan_mask]
-            pairs = zip(sane_lats, sane_lons)
+            projected = projector(np.column_stack((sane_lats, sane_lons)))
+            road_points.append(projected)
 
-            for start, end in zip(pairs, pairs[1:]):
-                start_proj = projector(start)
-                end_proj = projector(end)
+            for start_proj, end_proj in zip(projected, projected[1:]):
                 self.segments.append((start_proj, end_proj))
-
-        self._build_aabb_tree()
+                self.way_ids.append(road_id)
+                self.lane_ids.append(0)
+
+        # These maps have no node IDs, so roads are joined wherever they have
+        # a point in common (to the nearest millimetre)
+        sizes = [len(points) for points in road_points]
+        all_points = np.concatenate(road_points).reshape((-1, 2))
+        _, firsts, self.way_nodes = np.unique(
+            np.round(all_points, 3), axis=0, return_index=True,
+            return_inverse=True
+        )
+        self.node_xy = all_points[firsts]
+        self.way_nodes = self.way_nodes.astype(np.int64)
+        self.way_node_ptr = np.concatenate(([0], np.cumsum(sizes))) \
+            .astype(np.int64)
+        self.way_oneway = np.zeros(len(sizes), dtype=bool)
+        self.way_width = np.full(len(sizes), DEFAULT_LANE_WIDTH)
@@ -1,11 +1,30 @@
 """Noise models for common vehicle sensors."""
 
 from copy import deepcopy
+from itertools import izip
 
 import numpy as np
 
+from observation import Trajectory
 
-def brownian(step_size=1, shape=None):
+
+# Time constant (in seconds) of the correlated part of GPS error. Errors from
+# atmospheric delays and orbit/clock estimates wander on a scale of minutes.
+GPS_CORRELATION_TIME = 60.0
+
+# Urban canyons: multipath bursts, during which fixes are pulled off in some
+# constant direction, and outages, during which there are no fixes at all.
+# Gaps between and lengths of both are exponentially distributed with these
+# means (in seconds). Burst biases are Gaussian with URBAN_BIAS_SCALE times
+# the GPS standard deviation along each axis.
+URBAN_BURST_GAP = 60.0
+URBAN_BURST_LENGTH = 10.0
+URBAN_BIAS_SCALE = 2.0
+URBAN_OUTAGE_GAP = 120.0
+URBAN_OUTAGE_LENGTH = 5.0
+
+
+def brownian(step_size=1, shape=None, rng=np.random):
     """Yields a sequence of points with the given shape, each of which is one
     step_size step away from the previous one in a random direction (where
     direction is chosen uniformly)."""
@@ -14,34 +33,201 @@ def brownian(step_size=1, shape=None):
     mean = np.zeros(shape)
     while True:
         yield mean
-        gauss_vars = np.random.standard_normal(shape)
+        gauss_vars = rng.standard_normal(shape)
         direction = gauss_vars / np.sqrt(np.sum(gauss_vars ** 2))
         mean += step_size * direction
 
 
-def noisify(obs_gen, gps_stddev, speed_noise, gyro_stddev):
+class WhiteGPSNoise(object):
+    """Independent isotropic Gaussian GPS errors. This is *not* a very GPS-like
+    noise model, but it's what we've always used.
+
+    GPS noise models are sampled at increasing times, either all at once or a
+    few at a time, and each sample carries on from the last. Errors are NaN
+    while there is no fix."""
+    def __init__(self, stddev):
+        self.stddev = stddev
+
+    def sample(self, times, rng=np.random):
+        """(N, 2) array of errors at each of the N times given."""
+        return self.stddev * rng.standard_normal((len(times), 2))
+
+
+class GaussMarkovGPSNoise(WhiteGPSNoise):
+    """First order Gauss-Markov GPS errors: each axis drifts as an
+    Ornstein-Uhlenbeck process with the given (stationary) standard deviation
+    and time constant, so consecutive fixes have similar errors."""
+    def __init__(self, stddev, correlation_time=GPS_CORRELATION_TIME):
+        super(GaussMarkovGPSNoise, self).__init__(stddev)
+        self.correlation_time = correlation_time
+        self._time = None
+        self._error = None
+
+    def sample(self, times, rng=np.random):
+        times = np.asarray(times, dtype=float)
+        noise = rng.standard_normal((len(times), 2))
+        errors = np.empty((len(times), 2))
+        start = 0
+        if self._time is None and len(times):
+            # Begin in the stationary distribution
+            errors[0] = self.stddev * noise[0]
+            self._time, self._error = times[0], errors[0]
+            start = 1
+
+        # Each error is decays[k] * (previous error + sum of the innovations
+        # so far, scaled by 1 / decays[j]), where decays are relative to the
+        # previous error's time. Blocks are kept short enough that 1 / decays
+        # can't overflow.
+        tau = self.correlation_time
+        while start < len(times):
+            end = np.searchsorted(times, self._time + 100 * tau, 'right')
+            end = max(end, start + 1)
+            elapsed = np.minimum((times[start:end] - self._time) / tau, 100)
+            decays = np.exp(-elapsed)
+            step_decays = decays / np.concatenate(([1], decays[:-1]))
+            scales = self.stddev * np.sqrt(1 - step_decays ** 2)
+            innovations = noise[start:end] * (scales / decays)[:, np.newaxis]
+            errors[start:end] = decays[:, np.newaxis] \
+                * (self._error + np.cumsum(innovations, axis=0))
+            self._time, self._error = times[end - 1], errors[end - 1]
+            start = end
+        return errors
+
+
+class UrbanGPSNoise(GaussMarkovGPSNoise):
+    """Gauss-Markov GPS errors plus the effects of driving between tall
+    buildings: bursts of multipath bias and signal outages (see the URBAN_*
+    constants)."""
+    def __init__(self, stddev, correlation_time=GPS_CORRELATION_TIME):
+        super(UrbanGPSNoise, self).__init__(stddev, correlation_time)
+        self._bursts = _OnOffProcess(URBAN_BURST_GAP, URBAN_BURST_LENGTH)
+        self._outages = _OnOffProcess(URBAN_OUTAGE_GAP, URBAN_OUTAGE_LENGTH)
+        self._biases = np.empty((0, 2))
+
+    def sample(self, times, rng=np.random):
+        times = np.asarray(times, dtype=float)
+        errors = super(UrbanGPSNoise, self).sample(times, rng)
+        in_burst, bursts = self._bursts.sample(times, rng)
+        new_bursts = self._bursts.count - len(self._biases)
+        if new_bursts > 0:
+            self._biases = np.concatenate((
+                self._biases, URBAN_BIAS_SCALE * self.stddev
+                * rng.standard_normal((new_bursts, 2))
+            ))
+        errors[in_burst] += self._biases[bursts[in_burst]]
+        in_outage, _ = self._outages.sample(times, rng)
+        errors[in_outage] = np.nan
+        return errors
+
+
+class _OnOffProcess(object):
+    """Alternating off and on periods with exponentially distributed lengths,
+    beginning with an off period."""
+    def __init__(self, mean_off, mean_on):
+        self.mean_off = mean_off
+        self.mean_on = mean_on
+        self.on = False
+        # Number of on periods begun so far
+        self.count = 0
+        self._next_switch = None
+
+    def sample(self, times, rng=np.random):
+        """Whether the process is on at each of the given (increasing) times,
+        and which on period (counting from 0) each time falls in, if any."""
+        if not len(times):
+            return np.zeros(0, dtype=bool), np.zeros(0, dtype=np.int64)
+        if self._next_switch is None:
+            self._next_switch = times[0] + rng.exponential(self.mean_off)
+        was_on, count = self.on, self.count
+        switches = []
+        while self._next_switch <= times[-1]:
+            switches.append(self._next_switch)
+            self.on = not self.on
+            if self.on:
+                self.count += 1
+                self._next_switch += rng.exponential(self.mean_on)
+            else:
+                self._next_switch += rng.exponential(self.mean_off)
+
+        num_switches = np.searchsorted(switches, times, 'right')
+        on = (num_switches % 2 == 1) != was_on
+        # On periods begin at odd numbered switches if we started off, and
+        # even numbered ones otherwise
+        begun = (num_switches + (not was_on)) // 2
+        return on, count - 1 + begun
+
+
+GPS_NOISE_MODELS = {
+    'white': WhiteGPSNoise,
+    'gauss-markov': GaussMarkovGPSNoise,
+    'urban': UrbanGPSNoise
+}
+
+
+def noisify(obs_gen, gps_stddev, speed_noise, gyro_stddev, rng=np.random,
+            gps_model='white'):
     """Applies GPS, gyroscope and speedometer noise to the given observation
-    sequence. Yields (ground truth, noisy observation) pairs."""
+    sequence. Returns an iterator over (ground truth, noisy observation)
+    pairs. Noise is drawn from rng, which may be a Generator or RandomState.
+    GPS noise follows the named model from GPS_NOISE_MODELS, with gps_stddev
+    as its standard deviation; noisy positions are NaN while there's no fix.
+
+    Trajectories are noisified all at once by noisify_trajectory, and the
+    pairs are views of the original and noisy trajectories. Other sequences
+    are noisified one observation at a time, as they're read."""
     assert 1 >= speed_noise >= 0
     assert gyro_stddev >= 0
     assert gps_stddev >= 0
 
+    if isinstance(obs_gen, Trajectory):
+        return izip(obs_gen, noisify_trajectory(
+            obs_gen, gps_stddev, speed_noise, gyro_stddev, rng, gps_model
+        ))
+    return _noisify_each(
+        obs_gen, gps_stddev, speed_noise, gyro_stddev, rng, gps_model
+    )
+
+
+def noisify_trajectory(trajectory, gps_stddev, speed_noise, gyro_stddev,
+                       rng=np.random, gps_model='white'):
+    """Vectorised noisify for a whole Trajectory. Returns a new Trajectory
+    with the same noise model applied to each column in one go; the original
+    is left untouched."""
+    # Emulates a miscalibrated speedometer
+    speedo_multiplier = 1 + rng.uniform(-speed_noise, speed_noise)
+    num_obs = len(trajectory)
+
+    gps_noise = GPS_NOISE_MODELS[gps_model](gps_stddev)
+    pos = trajectory.pos + gps_noise.sample(trajectory.times, rng)
+
+    data = trajectory.data.copy()
+    names = data.dtype.names
+    if 'wu' in names:
+        data['wu'] += rng.normal(0, gyro_stddev, size=num_obs)
+    if 'vf' in names:
+        data['vf'] *= speedo_multiplier
+
+    return Trajectory(trajectory.times, pos, data)
+
+
+def _noisify_each(obs_gen, gps_stddev, speed_noise, gyro_stddev, rng,
+                  gps_model):
+    """Generator doing the work of noisify for arbitrary observation
+    sequences."""
     # Emulates a miscalibrated speedometer
-    speedo_multiplier = 1 + np.random.uniform(-speed_noise, speed_noise)
+    speedo_multiplier = 1 + rng.uniform(-speed_noise, speed_noise)
+    gps_noise = GPS_NOISE_MODELS[gps_model](gps_stddev)
 
     for obs in obs_gen:
         new_obs = deepcopy(obs)
 
-        # Add some white normal noise to simulate an inaccurate positioning
-        # sensor. This is *not* a GPS-like noise model, but should do for now.
-        new_obs.pos = np.random.multivariate_normal(
-            obs.pos, gps_stddev**2 * np.eye(2)
-        )
+        # Simulate an inaccurate positioning sensor
+        new_obs.pos = obs.pos + gps_noise.sample([obs.time], rng)[0]
 
         # Add gyro noise. This will keep 95% of measurements within 5% of their
         # true values.
         if 'wu' in new_obs:
-            new_obs['wu'] += np.random.normal(0, gyro_stddev)
+            new_obs['wu'] += rng.normal(0, gyro_stddev)
 
         # Add speedometer noise
         if 'vf' in new_obs:
@@ -14,10 +14,15 @@ DATA_HEADERS = (
     'orimode'
 )
 
+# One float64 column per entry in DATA_HEADERS
+TRAJECTORY_DTYPE = np.dtype([(name, np.float64) for name in DATA_HEADERS])
+
 
 def coordinate_projector(reference_coords):
     """Returns a function which converts its supplied latitude and longitude to
-    easting (in metres) and northing (in metres).
+    easting (in metres) and northing (in metres). The function accepts either
+    a single (lat, lon) pair or an (N, 2) array of them, and has an inverse
+    attribute which converts (easting, northing) back to (lat, lon).
 
     Uses Mercator projection internally, hence the reference coordinates (used
     to derive scale factor to reduce distortion)."""
@@ -29,10 +34,26 @@ def coordinate_projector(reference_coords):
     pre_mult = earth_rad * np.cos(np.pi * ref_lat / 180.0)
 
     def inner(coords):
-        lat, lon = coords
-        x_rad = np.pi * lon / 180.0
-        y_rad = np.log(np.tan(np.pi * (0.25 + lat / 360.0)))
-        return np.array((pre_mult * x_rad, pre_mult * y_rad))
+        coords = np.asarray(coords, dtype=float)
+        rv = np.empty(coords.shape)
+        rv[..., 0] = (pre_mult * np.pi / 180.0) * coords[..., 1]
+        rv[..., 1] = pre_mult * np.log(
+            np.tan(np.pi * (0.25 + coords[..., 0] / 360.0))
+        )
+        return rv
+
+    def inverse(coords):
+        coords = np.asarray(coords, dtype=float)
+        rv = np.empty(coords.shape)
+        rv[..., 0] = 360.0 / np.pi * np.arctan(
+            np.exp(coords[..., 1] / pre_mult)
+        ) - 90
+        rv[..., 1] = (180.0 / (np.pi * pre_mult)) * coords[..., 0]
+        return rv
+
+    inner.inverse = inverse
+    # Lets maps which were projected with this function be cached
+    inner.reference_coords = (ref_lat, ref_lon)
 
     return inner
 
@@ -64,6 +85,81 @@ class Observation(object):
         )
 
 
+class Trajectory(object):
+    """A whole sequence of observations stored column-wise. Indexing or
+    iterating gives ObservationRow views, which behave like Observations."""
+    def __init__(self, times, pos, data):
+        # (N,) array of times, (N, 2) array of eastings and northings and
+        # length N structured array of everything else
+        self.times = times
+        self.pos = pos
+        self.data = data
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        return ObservationRow(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield ObservationRow(self, index)
+
+
+class ObservationRow(object):
+    """View of a single observation in a Trajectory. Setting items writes
+    through to the trajectory; deep copies are standalone Observations."""
+    __slots__ = ('trajectory', 'index')
+
+    def __init__(self, trajectory, index):
+        self.trajectory = trajectory
+        self.index = index
+
+    @property
+    def time(self):
+        return self.trajectory.times[self.index]
+
+    @property
+    def pos(self):
+        return self.trajectory.pos[self.index]
+
+    @property
+    def data(self):
+        record = self.trajectory.data[self.index]
+        return dict(zip(record.dtype.names, record.tolist()))
+
+    def __getitem__(self, key):
+        return self.trajectory.data[key][self.index]
+
+    def __setitem__(self, key, value):
+        self.trajectory.data[key][self.index] = value
+
+    def __contains__(self, key):
+        return key in self.trajectory.data.dtype.names
+
+    def __deepcopy__(self, memo):
+        return Observation(self.time, self.pos, self.data)
+
+    def __repr__(self):
+        return 'ObservationRow({}, {}, {})'.format(
+            self.time, self.pos, self.data
+        )
+
+
+def load_map_trajectory(fp, freq=10, projector=None):
+    """Read an entire file in the map trajectory format used by Brubaker et al
+    into a Trajectory. Equivalent to parse_map_trajectory, but much faster for
+    long trajectories."""
+    raw = np.array(fp.read().split(), dtype=np.float64)
+    data = raw.reshape((-1, len(DATA_HEADERS))).view(TRAJECTORY_DTYPE)
+    data = data.reshape((-1,))
+    times = np.arange(len(data)) / float(freq)
+    if projector is None:
+        projector = coordinate_projector((data['lat'][0], data['lon'][0]))
+    pos = projector(np.column_stack((data['lat'], data['lon'])))
+    return Trajectory(times, pos, data)
+
+
 def parse_map_trajectory(fp, freq=10, projector=None):
     """Generator returning series of observations from an iterable (presumed to
     be a file in the map trajectory format used by Brubaker et al)"""
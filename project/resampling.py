@@ -0,0 +1,97 @@
+"""Resampling schemes for particle filters. Each scheme takes a vector of
+normalised particle weights and returns a sorted vector of indices of the
+particles which should survive resampling. Schemes also accept an (F, N)
+array holding the weights of F independent filters, in which case each row
+is resampled separately and an (F, size) array of indices is returned.
+Random numbers are drawn from rng, which may be the numpy.random module, a
+RandomState or a Generator. See Douc et al. (2005) for a comparison of the
+schemes."""
+
+import numpy as np
+
+
+def _search(weights, positions):
+    """Find the particle whose slice of [0, 1) (as laid out by the cumulative
+    sum of weights) contains each of the sorted positions. Works row-wise for
+    2D weights and positions."""
+    cumsum = np.cumsum(weights, axis=-1)
+    # Guard against round-off leaving the last slice short of 1
+    cumsum[..., -1] = 1.0
+    if cumsum.ndim == 1:
+        return np.searchsorted(cumsum, positions, side='right')
+
+    # Shift each row up by its row number so that one search over the
+    # flattened array handles every row at once
+    rows, cols = cumsum.shape
+    offsets = np.arange(rows)[:, np.newaxis]
+    cumsum += offsets
+    flat = np.searchsorted(
+        cumsum.ravel(), (positions + offsets).ravel(), side='right'
+    )
+    return flat.reshape(positions.shape) - cols * offsets
+
+
+def _shape(weights, size):
+    """Shape of the index array to return for the given weights."""
+    if size is None:
+        size = weights.shape[-1]
+    return weights.shape[:-1] + (size,)
+
+
+def multinomial(weights, size=None, rng=np.random):
+    """Draw size independent samples from the weight distribution."""
+    shape = _shape(weights, size)
+    # Normalised partial sums of exponential variates are distributed like
+    # sorted uniforms, which saves sorting
+    positions = np.cumsum(
+        rng.exponential(size=shape[:-1] + (shape[-1] + 1,)), axis=-1
+    )
+    positions = positions[..., :-1] / positions[..., -1:]
+    return _search(weights, positions)
+
+
+def stratified(weights, size=None, rng=np.random):
+    """Draw one sample uniformly from each of size equal strata of [0, 1)."""
+    shape = _shape(weights, size)
+    positions = (np.arange(shape[-1]) + rng.uniform(size=shape)) \
+        / shape[-1]
+    return _search(weights, positions)
+
+
+def systematic(weights, size=None, rng=np.random):
+    """Like stratified, but use the same offset within each stratum."""
+    shape = _shape(weights, size)
+    offsets = rng.uniform(size=shape[:-1] + (1,))
+    positions = (np.arange(shape[-1]) + offsets) / shape[-1]
+    return _search(weights, positions)
+
+
+def residual(weights, size=None, rng=np.random):
+    """Deterministically keep floor(size * weight) copies of each particle,
+    then fill in the remainder by multinomial sampling on what's left of the
+    weights."""
+    if weights.ndim > 1:
+        # The number of deterministic copies varies from row to row, so
+        # there's not much to be gained by vectorising
+        return np.array([residual(row, size, rng) for row in weights])
+    if size is None:
+        size = len(weights)
+    scaled = size * weights
+    copies = np.floor(scaled).astype(int)
+    kept = np.repeat(np.arange(len(weights)), copies)[:size]
+    num_left = size - len(kept)
+    if num_left == 0:
+        return kept
+    leftovers = scaled - copies
+    leftovers /= np.sum(leftovers)
+    rest = multinomial(leftovers, num_left, rng)
+    return np.sort(np.concatenate((kept, rest)))
+
+
+# Maps names (as accepted by ParticleFilter) to resampling functions
+RESAMPLERS = {
+    'multinomial': multinomial,
+    'stratified': stratified,
+    'systematic': systematic,
+    'residual': residual
+}
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser, ArgumentTypeError, FileType
 from bz2 import BZ2File
 from csv import writer
-from sys import stdin, exit
+from socket import create_connection
+from sys import stdin, stderr, exit
 from termios import tcflush, TCIFLUSH
 from time import time as seconds
+from timeit import default_timer
 
 import numpy as np
 
@@ -17,10 +19,13 @@ manimation = None
 from filter import ParticleFilter
 from graphics import MapDisplay
 from map import Map, JoseMap
-from noise import noisify
-from observation import (parse_map_trajectory, coordinate_projector,
-                         parse_jose_map_trajectory)
+from noise import GPS_NOISE_MODELS, noisify
+from resampling import RESAMPLERS
+from observation import (load_map_trajectory, coordinate_projector,
+                         parse_jose_map_trajectory, parse_map_trajectory,
+                         Trajectory)
 from settings import KARLSRUHE_CENTER
+from util import BIT_GENERATORS, NullProfiler, Pacer, Profiler, make_rngs
 
 
 class StatsWriter(object):
@@ -34,23 +39,24 @@ class StatsWriter(object):
         ]
 
         if enable_map_f:
-            labels += ["map_pred_x", "map_pred_y", "map_pred_yaw", "map_hpe"]
+            labels += ["map_pred_x", "map_pred_y", "map_pred_yaw", "map_hpe",
+                       "map_particles"]
         if enable_plain_f:
             labels += ["plain_pred_x", "plain_pred_y", "plain_pred_yaw",
-                       "plain_hpe"]
+                       "plain_hpe", "plain_particles"]
         if enable_raw_gps:
             labels += ["gps_pred_x", "gps_pred_y", "gps_hpe"]
 
         self.writer.writerow(labels)
 
     def filter_columns(self, obs, f):
-        """Calculates predicted X, predicted Y, predicted yaw and HPE for a
-        filter, given some ground truth observation."""
+        """Calculates predicted X, predicted Y, predicted yaw, HPE and number
+        of particles for a filter, given some ground truth observation."""
         pred_x, pred_y, pred_yaw = f.state_estimate()
         pred_yaw = pred_y
         return [
             pred_x, pred_y, pred_yaw,
-            self.hpe(obs.pos, (pred_x, pred_y))
+            self.hpe(obs.pos, (pred_x, pred_y)), f.num_points
         ]
 
     def hpe(self, truth, guess):
@@ -75,25 +81,122 @@ class StatsWriter(object):
         self.writer.writerow(columns)
 
 
-def update_filter(f, obs, dt, give_fix=False, m=None):
-    if give_fix:
-        std = args.gpsstddev
-        f.gps_update(obs.pos, 8 if std == 0 else std)
-    f.auto_resample()
-    if m is not None:
-        f.map_update(m)
-    f.auto_resample()
-    # In the first step, dt will be None
-    if dt is not None:
-        if f.have_imu:
-            f.predict(dt, obs['vf'], obs['wu'])
-        else:
-            f.predict(dt)
-    f.normalise_weights()
+class DeadlineTracker(object):
+    """Keeps track of how long each step of a streaming run takes compared to
+    its time budget, optionally writing per-step latencies to a file
+    pointer."""
+    def __init__(self, budget, fp=None):
+        self.budget = budget
+        self.latencies = []
+        self.misses = 0
+        self.writer = None
+        if fp is not None:
+            self.writer = writer(fp)
+            self.writer.writerow(["time", "latency", "missed", "particles"])
+
+    def update(self, time, latency, particles):
+        """Record the latency of the step for the observation at the given
+        time. Returns True iff the step went over budget."""
+        missed = latency > self.budget
+        self.latencies.append(latency)
+        self.misses += missed
+        if self.writer is not None:
+            self.writer.writerow([time, latency, int(missed), particles])
+        return missed
+
+    def summary(self):
+        """Human-readable summary of latencies and deadline misses."""
+        if not self.latencies:
+            return "No steps taken"
+        p50, p99 = np.percentile(self.latencies, [50, 99])
+        return (
+            "{}/{} steps over {:.1f}ms budget; latency p50 {:.1f}ms, "
+            "p99 {:.1f}ms, max {:.1f}ms".format(
+                self.misses, len(self.latencies), 1000 * self.budget,
+                1000 * p50, 1000 * p99, 1000 * max(self.latencies)
+            )
+        )
+
+
+class FilterPipeline(object):
+    """Runs each step of a particle filter: measurement updates (GPS, then
+    map), each followed by a check of the effective number of particles and
+    resampling if needed, and finally prediction. Each stage is timed with
+    profiler, with stage names prefixed by name.
+
+    Resampling is only considered after updates which actually happen, since
+    the weights can't have changed otherwise. Checking after the GPS update
+    as well as the map update matters: with a single check after both, mean
+    HPE on KITTI 00 was noticeably worse. Weights aren't normalised at the
+    end of each step either, since the filter does that itself (at most once
+    per update) whenever they're needed."""
+    def __init__(self, f, m=None, gps_stddev=8, use_pos_accuracy=False,
+                 profiler=NullProfiler(), name='filter'):
+        """Step the filter f, weighting particles with the Map m if given.
+        GPS fixes have standard deviation gps_stddev, combined with the
+        receiver's own reported accuracy if use_pos_accuracy is set."""
+        self.f = f
+        self.m = m
+        self.gps_stddev = 8 if gps_stddev == 0 else gps_stddev
+        self.use_pos_accuracy = use_pos_accuracy
+        self.profiler = profiler
+        self.name = name
+        # Steps taken and how many of them resampled
+        self.steps = 0
+        self.resamples = 0
+
+    def step(self, obs, dt, give_fix=False):
+        """Run one step with the (noisy) observation obs, taken dt seconds
+        after the last (or None for the first step). The observation's
+        position is only used if give_fix is set."""
+        f = self.f
+        profiler = self.profiler
+        name = self.name
+        if give_fix:
+            stddev = self.gps_stddev
+            if self.use_pos_accuracy and 'pos_accuracy' in obs:
+                # Fixes have our simulated noise on top of the receiver's
+                stddev = np.hypot(stddev, obs['pos_accuracy'])
+            with profiler.stage(name + '.gps_update'):
+                f.gps_update(obs.pos, stddev)
+            self._auto_resample()
+        if self.m is not None:
+            with profiler.stage(name + '.map_update'):
+                f.map_update(self.m)
+            self._auto_resample()
+        # In the first step, dt will be None
+        if dt is not None:
+            with profiler.stage(name + '.predict'):
+                if f.have_imu:
+                    f.predict(dt, obs['vf'], obs['wu'])
+                else:
+                    f.predict(dt)
+        self.steps += 1
+
+    def _auto_resample(self):
+        with self.profiler.stage(self.name + '.resample'):
+            if self.f.auto_resample():
+                self.resamples += 1
+
+    def summary(self):
+        """Human-readable summary of how often the filter resampled."""
+        return "{}/{} steps resampled".format(self.resamples, self.steps)
+
+
+def min_particles(value):
+    """Type of --minparticles, which must be at least 2: a filter with a
+    single particle never resamples, so KLD-sampling could never grow it."""
+    count = int(value)
+    if count < 2:
+        raise ArgumentTypeError("must be at least 2, not {}".format(count))
+    return count
+
 
 parser = ArgumentParser()
 parser.add_argument(
-    'data_path', type=str, help="Map trajectory to read from"
+    'data_path', type=str,
+    help="Map trajectory to read from. With --stream, this may also be - "
+    "for stdin or tcp://HOST:PORT for a socket."
 )
 parser.add_argument(
     'map_path', type=str, help="Path to a .osm file containing map data"
@@ -116,7 +219,18 @@ parser.add_argument(
 )
 parser.add_argument(
     '--gpsstddev', type=float, default=8,
-    help="Standard deviation of white GPS noise"
+    help="Standard deviation of GPS noise"
+)
+parser.add_argument(
+    '--gps-noise-model', choices=sorted(GPS_NOISE_MODELS), default='white',
+    help="GPS noise model: white noise, correlated (Gauss-Markov) drift, or "
+    "drift plus urban canyon multipath bursts and outages. --gpsstddev "
+    "gives its standard deviation."
+)
+parser.add_argument(
+    '--useposaccuracy', action='store_true', default=False,
+    help="Combine --gpsstddev with the receiver's reported position accuracy "
+    "for each fix when weighting particles"
 )
 parser.add_argument(
     '--speederror', type=float, default=0.01,
@@ -144,6 +258,19 @@ parser.add_argument(
 parser.add_argument(
     '--particles', type=int, default=100, help="Number of particles to use"
 )
+parser.add_argument(
+    '--resampler', choices=sorted(RESAMPLERS), default='multinomial',
+    help="Resampling scheme to use in particle filters"
+)
+parser.add_argument(
+    '--seed', type=int, default=None,
+    help="Seed for all random number generators (random if not given)"
+)
+parser.add_argument(
+    '--bitgenerator', choices=BIT_GENERATORS, default=None,
+    help="Bit generator to use for random numbers (only mt19937 is "
+    "available before NumPy 1.17)"
+)
 parser.add_argument(
     '--enablemapfilter', action='store_true', default=False,
     help="Run filtering with map information"
@@ -156,10 +283,89 @@ parser.add_argument(
     '--enablerawgps', action='store_true', default=False,
     help="Attempt localisation using only GPS fixes"
 )
+parser.add_argument(
+    '--mapbackend', choices=('index', 'field', 'tiled'), default='index',
+    help="Answer map queries exactly with a spatial index, approximately "
+    "with a precomputed distance field, or with spatial indices over tiles "
+    "which are loaded as needed (for large maps; needs the map cache, and "
+    "is only exact within 50m of a road)"
+)
+parser.add_argument(
+    '--fieldres', type=float, default=0.5,
+    help="Resolution of the map distance field (m)"
+)
+parser.add_argument(
+    '--tilesize', type=float, default=500.0,
+    help="Size of map tiles (m)"
+)
+parser.add_argument(
+    '--maxtiles', type=int, default=64,
+    help="Most map tiles to keep in memory at once"
+)
+parser.add_argument(
+    '--distcache', type=float, default=None, metavar='CELL',
+    help="Cache map distances for cells of this size (m), answering queries "
+    "from the centre of each point's cell. 0 only skips duplicate points, "
+    "keeping distances exact."
+)
+parser.add_argument(
+    '--distcachesize', type=int, default=1 << 16,
+    help="Number of slots in the --distcache table"
+)
+parser.add_argument(
+    '--mapcache', type=str, default='mapcache',
+    help="Directory in which to cache compiled maps"
+)
+parser.add_argument(
+    '--nomapcache', action='store_true', default=False,
+    help="Always compile maps from scratch, without using the cache"
+)
 parser.add_argument(
     '--noimu', action='store_true', default=False,
     help="Should the IMU be disabled for the map filter?"
 )
+parser.add_argument(
+    '--stream', action='store_true', default=False,
+    help="Read observations one at a time and process them in real time, "
+    "reporting per-step latency"
+)
+parser.add_argument(
+    '--budget', type=float, default=None,
+    help="Time budget for each step in --stream mode, in seconds (defaults "
+    "to 1 / --freq)"
+)
+parser.add_argument(
+    '--latencyout', type=FileType('w'), default=None,
+    help="Write per-step latencies in --stream mode to this file"
+)
+parser.add_argument(
+    '--adaptparticles', action='store_true', default=False,
+    help="In --stream mode, use fewer particles when steps go over budget"
+)
+parser.add_argument(
+    '--snaptoroads', action='store_true', default=False,
+    help="Keep the map filter's particles on roads, moving them along the "
+    "road graph"
+)
+parser.add_argument(
+    '--adaptive', action='store_true', default=False,
+    help="Use KLD-sampling to choose the number of particles each time a "
+    "filter resamples"
+)
+parser.add_argument(
+    '--minparticles', type=min_particles, default=20,
+    help="Never use fewer than this many particles with --adaptive or "
+    "--adaptparticles"
+)
+parser.add_argument(
+    '--maxparticles', type=int, default=None,
+    help="Never use more than this many particles with --adaptive "
+    "(defaults to --particles)"
+)
+parser.add_argument(
+    '--profile-out', type=FileType('w'), default=None,
+    help="Write a CSV summary of time spent in each stage to this file"
+)
 parser.add_argument(
     '--tracegroundtruth', action='store_true', default=False,
     help="Produce a trace of ground truth."
@@ -174,24 +380,84 @@ parser.add_argument(
 )
 
 
+def open_stream(path):
+    """Open a file-like object for the trajectory at path, which may be - for
+    stdin or tcp://HOST:PORT to connect to a socket."""
+    if path == '-':
+        return stdin
+    if path.startswith('tcp://'):
+        host, port = path[len('tcp://'):].rsplit(':', 1)
+        return create_connection((host, int(port))).makefile('rb')
+    if path.endswith('.bz2'):
+        return BZ2File(path)
+    return open(path, 'rb')
+
+
+def load_trajectory(args):
+    """Load the trajectory given on the command line. Returns an iterable of
+    observations."""
+    proj = coordinate_projector(KARLSRUHE_CENTER)
+    if args.stream:
+        trajectory_fp = open_stream(args.data_path)
+        # Iterating over a file reads ahead in large chunks, which would
+        # stall live sources
+        lines = iter(trajectory_fp.readline, b'')
+        if args.jose:
+            assert args.noimu, "Jose's data has no IMU info; use --noimu"
+            return parse_jose_map_trajectory(lines, proj)
+        return parse_map_trajectory(lines, args.freq, proj)
+    if args.data_path.endswith('.bz2'):
+        trajectory_fp = BZ2File(args.data_path)
+    else:
+        trajectory_fp = open(args.data_path, 'rb')
+    if args.jose:
+        assert args.noimu, "Jose's data has no IMU info; use --noimu"
+        return parse_jose_map_trajectory(trajectory_fp, proj)
+    try:
+        return load_map_trajectory(trajectory_fp, args.freq, proj)
+    finally:
+        trajectory_fp.close()
+
+
+def load_map(args):
+    """Load the map given on the command line."""
+    proj = coordinate_projector(KARLSRUHE_CENTER)
+    if args.mapbackend == 'field':
+        field_res = args.fieldres
+    else:
+        field_res = None
+    tile_size = args.tilesize if args.mapbackend == 'tiled' else None
+    map_cache = None if args.nomapcache else args.mapcache
+    map_class = JoseMap if args.jose else Map
+    return map_class(
+        args.map_path, proj, field_res, map_cache, tile_size, args.maxtiles,
+        args.distcache, args.distcachesize
+    )
+
+
 class TheMainLoop(object):
-    def __init__(self, args):
+    def __init__(self, args, m=None, trajectory=None):
+        """Set up a run with the given command line arguments. An
+        already-loaded map and trajectory may be supplied to save loading
+        them again."""
         self.args = args
         self.disable_for = 0
-        proj = coordinate_projector(KARLSRUHE_CENTER)
-        if args.data_path.endswith('.bz2'):
-            trajectory_fp = BZ2File(args.data_path)
-        else:
-            trajectory_fp = open(args.data_path, 'rb')
-        if args.jose:
-            assert args.noimu, "Jose's data has no IMU info; use --noimu"
-            parsed = parse_jose_map_trajectory(trajectory_fp, proj)
-            self.m = JoseMap(args.map_path, proj)
+        if args.profile_out is not None:
+            self.profiler = Profiler()
         else:
-            parsed = parse_map_trajectory(trajectory_fp, args.freq, proj)
-            self.m = Map(args.map_path, proj)
+            self.profiler = NullProfiler()
+        if trajectory is None:
+            with self.profiler.stage('load_trajectory'):
+                trajectory = load_trajectory(args)
+        parsed = trajectory
+        if m is None:
+            with self.profiler.stage('load_map'):
+                m = load_map(args)
+        self.m = m
         self.map_f = None
         self.plain_f = None
+        self.map_pipeline = None
+        self.plain_pipeline = None
 
         self.obs_per_fix = int(round(args.freq / float(args.gpsfreq)))
         if self.obs_per_fix < 1:
@@ -237,16 +503,105 @@ class TheMainLoop(object):
         self.obs_since_fix = 0
         self.last_fix = None
         self.last_time = None
-        self.noisified = noisify(
-            parsed, args.gpsstddev, args.speederror, args.gyrostddev
+        # Independent streams for each filter and the noise, so that (for
+        # example) disabling one filter doesn't change the other's results
+        self.map_rng, self.plain_rng, noise_rng = make_rngs(
+            args.seed, 3, args.bitgenerator
         )
+        noise_args = (
+            args.gpsstddev, args.speederror, args.gyrostddev, noise_rng,
+            args.gps_noise_model
+        )
+        # Whole trajectories are noisified in one go, up front, leaving only
+        # views of each (ground truth, noisy observation) pair to fetch
+        whole = isinstance(parsed, Trajectory)
+        if whole:
+            with self.profiler.stage('noisify'):
+                parsed = noisify(parsed, *noise_args)
+        # Fetching each observation is timed separately from loading, since
+        # parsing is lazy for streams and Jose's traces (and that time is
+        # excluded from noisification's time)
+        parsed = self.profiler.timed_iter('fetch', parsed)
+
+        # Most particles that each filter may use. In --stream mode, this
+        # is lowered when steps go over budget.
+        self.particle_limit = args.particles
+        if args.adaptive and args.maxparticles is not None:
+            self.particle_limit = args.maxparticles
+        self.pacer = None
+        if args.stream:
+            # Observations are released no faster than real time, and each
+            # step is timed from its observation's release
+            self.pacer = Pacer(parsed, lambda obs: obs.time)
+            parsed = self.profiler.timed_iter('wait', self.pacer)
+            budget = args.budget
+            if budget is None:
+                budget = 1.0 / args.freq
+            self.deadlines = DeadlineTracker(budget, args.latencyout)
+
+        if whole:
+            self.noisified = parsed
+        else:
+            self.noisified = self.profiler.timed_iter(
+                'noisify', noisify(parsed, *noise_args)
+            )
 
         assert args.jose or (not args.noimu or args.enablemapfilter), \
             "Map filter must be enabled for --noimu to take effect"
+        assert not (args.snaptoroads and args.noimu), \
+            "--snaptoroads needs IMU data"
 
     def cleanup(self):
         if self.args.movie is not None:
             self.writer.finish()
+        if self.args.profile_out is not None:
+            self.profiler.write_summary(self.args.profile_out)
+            self.args.profile_out.close()
+        if self.args.latencyout is not None:
+            self.args.latencyout.close()
+
+    def filters(self):
+        """All filters which have been created so far."""
+        return [f for f in (self.map_f, self.plain_f) if f is not None]
+
+    def make_filter(self, init_coords, have_map, rng):
+        """Create a particle filter as specified on the command line."""
+        args = self.args
+        kwargs = {}
+        if args.adaptive:
+            kwargs['min_points'] = args.minparticles
+            kwargs['max_points'] = self.particle_limit
+        if have_map and args.snaptoroads:
+            kwargs['graph'] = self.m.graph
+        return ParticleFilter(
+            args.particles, init_coords, 5, have_map, not args.noimu,
+            args.resampler, rng, **kwargs
+        )
+
+    def adapt_particles(self, latency):
+        """Shrink the filters if the last step went over budget, or grow them
+        back towards their original size if there's plenty of time to
+        spare."""
+        budget = self.deadlines.budget
+        limit = self.particle_limit
+        if latency > budget:
+            limit = max(self.args.minparticles, int(0.75 * limit))
+        elif latency < 0.5 * budget:
+            upper = self.args.particles
+            if self.args.adaptive and self.args.maxparticles is not None:
+                upper = self.args.maxparticles
+            limit = min(upper, int(1.25 * limit) + 1)
+        if limit == self.particle_limit:
+            return
+        self.particle_limit = limit
+        for f in self.filters():
+            if f.max_points is None:
+                f.resize(limit)
+            else:
+                # Let KLD-sampling choose the size, within the new limit
+                f.max_points = limit
+                if f.num_points > limit:
+                    f.resize(limit)
 
     def run(self):
         fixes = 0
@@ -260,68 +615,99 @@ class TheMainLoop(object):
                 dt = None
             self.last_time = obs.time
 
-            if self.last_fix is None and self.args.enablerawgps:
+            # GPS noise models give NaN positions during outages
+            have_fix = not np.isnan(noisy_obs.pos).any()
+
+            if self.last_fix is None and self.args.enablerawgps and have_fix:
                 self.last_fix = noisy_obs.pos
 
-            if args.jose:
+            if self.args.jose:
                 # Only give a GPS fix if it's fresh
                 visible = noisy_obs['signal']
                 fresh = noisy_obs.pos != self.last_fix
                 give_fix = visible and fresh
             else:
-                # Give a GPS fix whenever --gpsfreq says we should
-                give_fix = self.obs_since_fix >= self.obs_per_fix
+                # Give a GPS fix whenever --gpsfreq says we should (and there
+                # is one)
+                give_fix = have_fix \
+                    and self.obs_since_fix >= self.obs_per_fix
 
             if give_fix:
                 if self.last_fix is not None:
                     self.last_fix = noisy_obs.pos
                 self.obs_since_fix = 1
-                if args.gui or args.movie:
+                if self.args.gui or self.args.movie:
                     self.display.update_last_fix(noisy_obs.pos)
             else:
                 self.obs_since_fix += 1
 
-            if self.args.enablemapfilter and self.map_f is None:
-                self.map_f = ParticleFilter(
-                    args.particles, noisy_obs.pos, 5, True,
-                    not args.noimu
+            # Filters are started from the first GPS fix
+            if self.args.enablemapfilter and self.map_f is None \
+                    and have_fix:
+                with self.profiler.stage('map_filter.init'):
+                    self.map_f = self.make_filter(
+                        noisy_obs.pos, True, self.map_rng
+                    )
+                self.map_pipeline = FilterPipeline(
+                    self.map_f, self.m, self.args.gpsstddev,
+                    self.args.useposaccuracy, self.profiler, 'map_filter'
                 )
             elif self.map_f is not None:
-                update_filter(self.map_f, noisy_obs, dt, give_fix, self.m)
+                self.map_pipeline.step(noisy_obs, dt, give_fix)
 
-            if args.enableplainfilter and self.plain_f is None:
-                self.plain_f = ParticleFilter(
-                    args.particles, noisy_obs.pos, 5, False, not args.noimu
+            if self.args.enableplainfilter and self.plain_f is None \
+                    and have_fix:
+                with self.profiler.stage('plain_filter.init'):
+                    self.plain_f = self.make_filter(
+                        noisy_obs.pos, False, self.plain_rng
+                    )
+                self.plain_pipeline = FilterPipeline(
+                    self.plain_f, None, self.args.gpsstddev,
+                    self.args.useposaccuracy, self.profiler, 'plain_filter'
                 )
             elif self.plain_f is not None:
-                update_filter(self.plain_f, noisy_obs, dt, give_fix)
+                self.plain_pipeline.step(noisy_obs, dt, give_fix)
 
-            if args.gui and not self.disable_for:
-                self.update_display(obs)
+            if self.args.gui and not self.disable_for:
+                with self.profiler.stage('display'):
+                    self.update_display(obs)
                 self.interact()
-            elif args.movie:
-                self.update_display(obs)
+            elif self.args.movie:
+                with self.profiler.stage('display'):
+                    self.update_display(obs)
 
             if self.disable_for > 0:
                 self.disable_for -= 1
 
-            if args.gui or args.movie:
-                if args.tracegroundtruth:
-                    self.display.ground_truth_trace(obs.pos)
-                if args.traceestimate:
-                    f = None
-                    if self.map_f is not None:
-                        f = self.map_f
-                    if self.plain_f is not None:
-                        assert f is None, "Can only show one filter trace"
-                        f = self.plain_f
-                    self.display.state_estimate_trace(f.state_estimate()[:-1])
-
-            if args.out is not None:
-                self.stats_writer.update(
-                    obs, map_f=self.map_f, plain_f=self.plain_f,
-                    last_fix=self.last_fix
-                )
+            if self.args.gui or self.args.movie:
+                with self.profiler.stage('display'):
+                    if self.args.tracegroundtruth:
+                        self.display.ground_truth_trace(obs.pos)
+                    if self.args.traceestimate:
+                        f = None
+                        if self.map_f is not None:
+                            f = self.map_f
+                        if self.plain_f is not None:
+                            assert f is None, \
+                                "Can only show one filter trace"
+                            f = self.plain_f
+                        self.display.state_estimate_trace(
+                            f.state_estimate()[:-1]
+                        )
+
+            if self.args.out is not None:
+                with self.profiler.stage('stats'):
+                    self.stats_writer.update(
+                        obs, map_f=self.map_f, plain_f=self.plain_f,
+                        last_fix=self.last_fix
+                    )
+
+            if self.pacer is not None:
+                latency = default_timer() - self.pacer.release
+                particles = sum(f.num_points for f in self.filters())
+                self.deadlines.update(obs.time, latency, particles)
+                if self.args.adaptparticles:
+                    self.adapt_particles(latency)
 
         return fixes
 
@@ -399,4 +785,13 @@ if __name__ == '__main__':
     elapsed = seconds() - start
     print "Runtime: ", elapsed
     print "Fixes: ", fixes
+    # Diagnostics go to stderr, leaving stdout as scrape_table.py expects
+    if args.stream:
+        print >> stderr, "Deadlines: ", loop.deadlines.summary()
+    for label, pipeline in (('Map filter', loop.map_pipeline),
+                            ('Plain filter', loop.plain_pipeline)):
+        if pipeline is not None:
+            print >> stderr, "{}: {}".format(label, pipeline.summary())
+    if loop.m.dist_cache is not None:
+        print >> stderr, "Distance cache: ", loop.m.dist_cache.summary()
     loop.cleanup()
@@ -0,0 +1,393 @@
+"""Spatial indices for answering nearest-road queries over many points at
+once."""
+
+from collections import OrderedDict
+from os import getpid, makedirs, path as osp, rename
+
+import numpy as np
+
+from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
+
+
+def project_onto_segments(points, begins, ends):
+    """Find the closest point on each segment (begins[i], ends[i]) to the
+    corresponding point points[i]. Returns the distance to that closest point,
+    along with its position along the segment as a fraction in [0, 1]."""
+    delta = ends - begins
+    sq_lens = np.einsum('ij,ij->i', delta, delta)
+    # Zero-length segments are treated as points
+    sq_lens[sq_lens == 0] = 1
+    rel = points - begins
+    t = np.einsum('ij,ij->i', rel, delta) / sq_lens
+    np.clip(t, 0, 1, out=t)
+    rel -= t[:, np.newaxis] * delta
+    return np.sqrt(np.einsum('ij,ij->i', rel, rel)), t
+
+
+class SegmentIndex(object):
+    """Exact nearest-segment index for 2D line segments. Each segment is
+    sampled at regular intervals and the samples are put in a k-d tree; the
+    nearest few samples to a query point then give a small set of candidate
+    segments, which are checked exactly."""
+    def __init__(self, segments, spacing=2.0, k=8):
+        """Index an (M, 2, 2) array of segments, where segments[i, 0] and
+        segments[i, 1] are the endpoints of the ith segment. Samples will be
+        placed at most spacing metres apart, and k candidate samples will be
+        retrieved per query point to begin with."""
+        self.segments = np.asarray(segments, dtype=float).reshape((-1, 2, 2))
+        self._begins = np.ascontiguousarray(self.segments[:, 0])
+        self._ends = np.ascontiguousarray(self.segments[:, 1])
+        self.k = k
+
+        # Split each segment into equal pieces no longer than spacing and put
+        # one sample in the middle of each piece
+        deltas = self._ends - self._begins
+        lengths = np.sqrt(np.einsum('ij,ij->i', deltas, deltas))
+        pieces = np.maximum(1, np.ceil(lengths / spacing)).astype(int)
+        self._sample_seg = np.repeat(np.arange(len(pieces)), pieces)
+        firsts = np.repeat(np.cumsum(pieces) - pieces, pieces)
+        piece_idx = np.arange(self._sample_seg.size) - firsts
+        t = (piece_idx + 0.5) / pieces[self._sample_seg]
+        samples = self._begins[self._sample_seg] \
+            + t[:, np.newaxis] * deltas[self._sample_seg]
+        self._tree = cKDTree(samples)
+
+        # Every point on a segment is at most this far from some sample of
+        # that segment
+        if len(pieces):
+            self._slack = 0.5 * np.max(lengths / pieces)
+        else:
+            self._slack = 0
+
+    def query(self, points):
+        """Find the nearest segment to each of the (N, 2) points given. Returns
+        an array of distances to those segments and an array of segment
+        indices."""
+        points = np.asarray(points, dtype=float).reshape((-1, 2))
+        dists = np.empty((len(points),))
+        seg_ids = np.empty((len(points),), dtype=int)
+        num_samples = self._tree.n
+        pending = np.arange(len(points))
+        k = self.k
+
+        while pending.size:
+            k = min(k, num_samples)
+            pending_points = points[pending]
+            sample_dists, sample_ids = self._tree.query(pending_points, k=k)
+            if k == 1:
+                sample_dists = sample_dists[:, np.newaxis]
+                sample_ids = sample_ids[:, np.newaxis]
+
+            candidates = self._sample_seg[sample_ids]
+            flat = candidates.ravel()
+            cand_dists, _ = project_onto_segments(
+                np.repeat(pending_points, k, axis=0), self._begins[flat],
+                self._ends[flat]
+            )
+            cand_dists = cand_dists.reshape(candidates.shape)
+            best = np.argmin(cand_dists, axis=1)
+            rows = np.arange(len(pending))
+            dists[pending] = cand_dists[rows, best]
+            seg_ids[pending] = candidates[rows, best]
+
+            if k == num_samples:
+                break
+
+            # A segment which wasn't a candidate can only be closer than the
+            # best candidate if it has a sample within best + slack of the
+            # query point. If the kth sample is further away than that, then
+            # all such samples were retrieved and we're done.
+            done = sample_dists[:, -1] > dists[pending] + self._slack
+            pending = pending[~done]
+            k *= 2
+
+        return dists, seg_ids
+
+    def dists(self, points):
+        """Distance from each of the (N, 2) points to its nearest segment."""
+        return self.query(points)[0]
+
+
+class DistanceField(object):
+    """Approximate distances to the nearest segment, precomputed on a regular
+    grid and answered by bilinear interpolation. Accuracy is limited by the
+    grid resolution, but each query takes constant time."""
+    def __init__(self, segments, resolution=0.5, margin=20.0):
+        """Rasterise an (M, 2, 2) array of segments onto a grid with the given
+        resolution (in metres) which extends margin metres beyond the
+        segments in each direction, then compute the distance from each grid
+        point to the nearest rasterised segment."""
+        segments = np.asarray(segments, dtype=float).reshape((-1, 2, 2))
+        self.resolution = resolution
+        endpoints = segments.reshape((-1, 2))
+        self.origin = endpoints.min(axis=0) - margin
+        extent = endpoints.max(axis=0) + margin - self.origin
+        self.shape = tuple(np.ceil(extent / resolution).astype(int) + 1)
+
+        # Sample each segment (including endpoints) at no more than half a
+        # cell apart so that the rasterised segments have no gaps
+        begins = segments[:, 0]
+        deltas = segments[:, 1] - begins
+        lengths = np.sqrt(np.einsum('ij,ij->i', deltas, deltas))
+        pieces = np.maximum(1, np.ceil(2 * lengths / resolution)).astype(int)
+        sample_seg = np.repeat(np.arange(len(pieces)), pieces + 1)
+        firsts = np.repeat(np.cumsum(pieces + 1) - pieces - 1, pieces + 1)
+        t = (np.arange(sample_seg.size) - firsts) / \
+            pieces[sample_seg].astype(float)
+        samples = begins[sample_seg] + t[:, np.newaxis] * deltas[sample_seg]
+        cells = np.round((samples - self.origin) / resolution).astype(int)
+
+        # distance_transform_edt gives the distance to the nearest zero
+        off_road = np.ones(self.shape, dtype=bool)
+        off_road[cells[:, 0], cells[:, 1]] = False
+        self.field = distance_transform_edt(off_road, sampling=resolution) \
+            .astype(np.float32)
+
+    @classmethod
+    def load(cls, prefix):
+        """Load a distance field written by save, memory mapping the grid."""
+        rv = cls.__new__(cls)
+        origin_res = np.load(prefix + '-origin.npy')
+        rv.origin = origin_res[:2]
+        rv.resolution = float(origin_res[2])
+        rv.field = np.load(prefix + '-field.npy', mmap_mode='r')
+        rv.shape = rv.field.shape
+        return rv
+
+    def save(self, prefix):
+        """Write this distance field to a pair of .npy files beginning with
+        prefix. The grid is written last (and atomically), so its presence
+        means that the field is complete."""
+        to_write = (
+            ('origin', np.append(self.origin, self.resolution)),
+            ('field', self.field)
+        )
+        for suffix, array in to_write:
+            _save_atomic('{}-{}.npy'.format(prefix, suffix), array)
+
+    def dists(self, points):
+        """Interpolated distance from each of the (N, 2) points to its nearest
+        segment. Points outside the grid are clamped to its edge, and the
+        distance to the edge is added on."""
+        points = np.asarray(points, dtype=float).reshape((-1, 2))
+        rel = (points - self.origin) / self.resolution
+        upper = np.array(self.shape) - 1
+        clamped = np.clip(rel, 0, upper)
+        rel -= clamped
+        outside = self.resolution * np.sqrt(np.einsum('ij,ij->i', rel, rel))
+
+        base = np.minimum(clamped.astype(int), upper - 1)
+        fx, fy = (clamped - base).T
+        ix, iy = base.T
+        f = self.field
+        return f[ix, iy] * (1 - fx) * (1 - fy) \
+            + f[ix + 1, iy] * fx * (1 - fy) \
+            + f[ix, iy + 1] * (1 - fx) * fy \
+            + f[ix + 1, iy + 1] * fx * fy \
+            + outside
+
+
+class TiledSegmentIndex(object):
+    """Nearest-segment index for maps too large to keep in memory at once.
+    Segments are bucketed into square tiles ahead of time (see build), with
+    each tile's segments stored in a separate file. Tiles are loaded as query
+    points land in them and kept in a least-recently-used cache, so memory
+    use is bounded by the cache size rather than the size of the map.
+
+    Each tile holds every segment within margin metres of it, so distances of
+    up to margin are exact. Larger distances are only upper bounds, and points
+    in tiles with no segments nearby are given a distance of margin."""
+    def __init__(self, directory, max_tiles=64):
+        """Open tiles written to directory by build, keeping at most max_tiles
+        tiles in memory."""
+        self.directory = directory
+        self.max_tiles = max_tiles
+        self.tile_size, self.margin = np.load(osp.join(directory, 'meta.npy'))
+        keys = np.load(osp.join(directory, 'keys.npy'))
+        self._keys = set(map(tuple, keys.tolist()))
+        self._cache = OrderedDict()
+        self.loads = 0
+
+    @staticmethod
+    def exists(directory):
+        """Whether a complete set of tiles has been written to directory."""
+        return osp.exists(osp.join(directory, 'meta.npy'))
+
+    @staticmethod
+    def build(segments, directory, tile_size=500.0, margin=50.0):
+        """Bucket an (M, 2, 2) array of segments into tiles of tile_size
+        metres square and write them to directory. Metadata is written last
+        (and atomically), so its presence means that the tiles are
+        complete."""
+        segments = np.asarray(segments, dtype=float).reshape((-1, 2, 2))
+        if not osp.isdir(directory):
+            try:
+                makedirs(directory)
+            except OSError:
+                # Another process may be building the same tiles
+                if not osp.isdir(directory):
+                    raise
+
+        # Find the range of tiles which each segment's bounding box (padded by
+        # margin) overlaps, then list every (segment, tile) pair
+        lo = np.floor((segments.min(axis=1) - margin) / tile_size) \
+            .astype(np.int64)
+        hi = np.floor((segments.max(axis=1) + margin) / tile_size) \
+            .astype(np.int64)
+        spans = hi - lo + 1
+        counts = spans[:, 0] * spans[:, 1]
+        seg_ids = np.repeat(np.arange(len(segments)), counts)
+        local = np.arange(seg_ids.size) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        tile_x = lo[seg_ids, 0] + local // spans[seg_ids, 1]
+        tile_y = lo[seg_ids, 1] + local % spans[seg_ids, 1]
+
+        order = np.lexsort((tile_y, tile_x))
+        tile_x, tile_y, seg_ids = tile_x[order], tile_y[order], seg_ids[order]
+        starts = np.flatnonzero(np.concatenate((
+            [True], (np.diff(tile_x) != 0) | (np.diff(tile_y) != 0)
+        )))
+        ends = np.append(starts[1:], len(seg_ids))
+        for start, end in zip(starts, ends):
+            key = (tile_x[start], tile_y[start])
+            _save_atomic(
+                TiledSegmentIndex._tile_path(directory, key),
+                segments[seg_ids[start:end]]
+            )
+
+        keys = np.column_stack((tile_x[starts], tile_y[starts]))
+        _save_atomic(osp.join(directory, 'keys.npy'), keys)
+        _save_atomic(
+            osp.join(directory, 'meta.npy'), np.array([tile_size, margin])
+        )
+
+    @staticmethod
+    def _tile_path(directory, key):
+        return osp.join(directory, 'tile_{}_{}.npy'.format(*key))
+
+    def _tile(self, key):
+        """SegmentIndex for the tile with the given key (or None if the tile
+        is empty), loading it if necessary."""
+        try:
+            index = self._cache.pop(key)
+        except KeyError:
+            index = None
+            if key in self._keys:
+                index = SegmentIndex(
+                    np.load(self._tile_path(self.directory, key))
+                )
+                self.loads += 1
+            if len(self._cache) >= self.max_tiles:
+                # Evict the least recently used tile
+                self._cache.popitem(last=False)
+        self._cache[key] = index
+        return index
+
+    def dists(self, points):
+        """Distance from each of the (N, 2) points to its nearest segment.
+        Every tile containing a point is loaded, if it isn't already."""
+        points = np.asarray(points, dtype=float).reshape((-1, 2))
+        keys = np.floor(points / self.tile_size).astype(np.int64)
+        rv = np.empty((len(points),))
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for i, key in enumerate(unique_keys.tolist()):
+            in_tile = inverse == i
+            index = self._tile(tuple(key))
+            if index is None:
+                rv[in_tile] = self.margin
+            else:
+                rv[in_tile] = index.dists(points[in_tile])
+        return rv
+
+
+class DistanceCache(object):
+    """Cache in front of a nearest-segment index (anything with a dists
+    method, like the classes above). Identical query points within a batch
+    are only looked up once, which helps straight after resampling, when many
+    particles are copies of each other.
+
+    If cell_size is nonzero, query points are also quantised to a grid of
+    cells that size, and each cell is given the distance from its centre.
+    Those distances are remembered across batches in a direct mapped table
+    with size slots, so particles which stay near the same place from one
+    step to the next don't need the index at all. Distances are then
+    approximate, with error at most cell_size / sqrt(2)."""
+    # Large odd multipliers for hashing cells into slots
+    _HASH_X = 73856093
+    _HASH_Y = 19349663
+
+    def __init__(self, index, cell_size=0, size=1 << 16):
+        self.index = index
+        self.cell_size = cell_size
+        self.size = size
+        if cell_size:
+            # No real cell is this far from the origin, so empty slots never
+            # match
+            self._cells = np.full(
+                (size, 2), np.iinfo(np.int64).min, dtype=np.int64
+            )
+            self._values = np.empty((size,))
+        # Points queried, distinct points (or cells) among them, and distinct
+        # points found in the table. Only distinct - hits were looked up in
+        # the index.
+        self.queries = 0
+        self.distinct = 0
+        self.hits = 0
+
+    @property
+    def hit_rate(self):
+        """Fraction of query points answered without using the index."""
+        if not self.queries:
+            return 0.0
+        return 1 - (self.distinct - self.hits) / float(self.queries)
+
+    def summary(self):
+        """Human-readable summary of the counters."""
+        return (
+            "{} points, {} distinct, {} table hits; {:.1%} answered without "
+            "the index".format(
+                self.queries, self.distinct, self.hits, self.hit_rate
+            )
+        )
+
+    def dists(self, points):
+        """Distance from each of the (N, 2) points to its nearest segment, as
+        given by the index (subject to quantisation; see above)."""
+        points = np.asarray(points, dtype=float).reshape((-1, 2))
+        self.queries += len(points)
+        if not self.cell_size:
+            unique_points, inverse = np.unique(
+                points, axis=0, return_inverse=True
+            )
+            self.distinct += len(unique_points)
+            return self.index.dists(unique_points)[inverse.ravel()]
+
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        self.distinct += len(cells)
+        slots = np.bitwise_xor(
+            cells[:, 0] * self._HASH_X, cells[:, 1] * self._HASH_Y
+        ) % self.size
+        hit = np.all(self._cells[slots] == cells, axis=1)
+        self.hits += np.count_nonzero(hit)
+
+        values = self._values[slots]
+        miss = np.flatnonzero(~hit)
+        if miss.size:
+            centres = (cells[miss] + 0.5) * self.cell_size
+            values[miss] = self.index.dists(centres)
+            # Where several missed cells share a slot, the last one wins
+            self._cells[slots[miss]] = cells[miss]
+            self._values[slots[miss]] = values[miss]
+        return values[inverse.ravel()]
+
+
+def _save_atomic(path, array):
+    """np.save array to path via a temporary file, so that readers never see
+    a partially written file."""
+    tmp_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], getpid())
+    np.save(tmp_path, array)
+    rename(tmp_path, path)
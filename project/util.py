@@ -1,8 +1,20 @@
 """Assorted Python utilities which aren't specific to the project"""
 
+from collections import defaultdict
+from csv import writer
 from functools import wraps
+from time import sleep
 from timeit import default_timer
 
+import numpy as np
+
+# Bit generators which can be passed to make_rngs. Versions of NumPy before
+# 1.17 only have RandomState, which is always MT19937.
+if hasattr(np.random, 'SeedSequence'):
+    BIT_GENERATORS = ('pcg64', 'philox', 'mt19937')
+else:
+    BIT_GENERATORS = ('mt19937',)
+
 
 def timed(f):
     """Decorator to measure the runtime of a function and print it to
@@ -23,3 +35,156 @@ def timed(f):
         return rv
 
     return inner
+
+
+def make_rngs(seed, count, bit_generator=None):
+    """Make count independent random number generators from a single seed
+    (or from system entropy if seed is None).
+
+    With NumPy 1.17 or later these are numpy.random.Generator instances
+    with the named bit generator (PCG64 by default), seeded from spawned
+    SeedSequences. Older versions of NumPy only support RandomState, so
+    each stream is a RandomState seeded from a master RandomState."""
+    if hasattr(np.random, 'SeedSequence'):
+        bit_gen_class = {
+            'pcg64': np.random.PCG64,
+            'philox': np.random.Philox,
+            'mt19937': np.random.MT19937
+        }[bit_generator or 'pcg64']
+        children = np.random.SeedSequence(seed).spawn(count)
+        return [np.random.Generator(bit_gen_class(c)) for c in children]
+
+    if bit_generator not in (None, 'mt19937'):
+        raise ValueError(
+            "Bit generator {} needs NumPy 1.17+".format(bit_generator)
+        )
+    master = np.random.RandomState(seed)
+    seeds = master.randint(0, 2**31 - 1, size=count)
+    return [np.random.RandomState(s) for s in seeds]
+
+
+class Pacer(object):
+    """Iterates over timestamped items no faster than real time, so that a
+    recorded sequence can be replayed as if it were live. time_of should give
+    the timestamp (in seconds) of an item. Items which arrive later than
+    their timestamp says they should are passed on immediately. After each
+    item is yielded, release holds the wall clock time at which it became
+    available."""
+    def __init__(self, items, time_of):
+        self.items = items
+        self.time_of = time_of
+        self.release = None
+
+    def __iter__(self):
+        start_wall = start_time = None
+        for item in self.items:
+            now = default_timer()
+            stamp = self.time_of(item)
+            if start_wall is None:
+                start_wall, start_time = now, stamp
+            due = start_wall + (stamp - start_time)
+            if due > now:
+                sleep(due - now)
+                now = default_timer()
+            self.release = now
+            yield item
+
+
+class Profiler(object):
+    """Records the time taken by each call to each named stage of a
+    computation. Stages may be nested, in which case the time recorded for
+    the outer stage excludes the time spent in the inner one."""
+
+    # Upper bounds (in seconds) of the histogram buckets in summaries
+    BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, float('inf'))
+
+    def __init__(self):
+        # Maps stage names to lists of per-call timings
+        self.timings = defaultdict(list)
+        # Stack of [name, start time, time spent in nested stages]
+        self._stack = []
+
+    def stage(self, name):
+        """Context manager which times its body as one call to the named
+        stage."""
+        return _ProfiledStage(self, name)
+
+    def timed_iter(self, name, iterable):
+        """Wrap iterable so that each item fetched counts as one call to the
+        named stage."""
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def _enter(self, name):
+        self._stack.append([name, default_timer(), 0.0])
+
+    def _exit(self):
+        name, start, nested = self._stack.pop()
+        elapsed = default_timer() - start
+        self.timings[name].append(elapsed - nested)
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def write_summary(self, fp):
+        """Write a CSV summary of each stage's timings to fp, including a
+        histogram of per-call times."""
+        w = writer(fp)
+        w.writerow(
+            ['stage', 'calls', 'total_s', 'mean_s', 'p50_s', 'p90_s',
+             'p99_s', 'max_s'] +
+            ['under_{:g}s'.format(b) for b in self.BUCKETS[:-1]] +
+            ['over_{:g}s'.format(self.BUCKETS[-2])]
+        )
+        for name in sorted(self.timings):
+            times = np.array(self.timings[name])
+            counts = np.bincount(
+                np.searchsorted(self.BUCKETS, times),
+                minlength=len(self.BUCKETS)
+            )
+            w.writerow(
+                [name, len(times), times.sum(), times.mean()] +
+                list(np.percentile(times, [50, 90, 99])) +
+                [times.max()] + list(counts)
+            )
+
+
+class NullProfiler(object):
+    """Stands in for a Profiler when profiling is disabled, doing as little
+    as possible."""
+    def stage(self, name):
+        return _null_stage
+
+    def timed_iter(self, name, iterable):
+        return iterable
+
+
+class _ProfiledStage(object):
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.profiler._exit()
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_stage = _NullStage()